@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Benchmarks how long `import srchilite` takes in a fresh interpreter, and
+checks it against a time budget. Results are written as JSON, and the exit
+status is non-zero when the budget is exceeded.
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+# the budget for importing srchilite, on top of starting the interpreter
+IMPORT_BUDGET_MS = 25.0
+
+CHILD = """\
+import time
+t0 = time.perf_counter()
+import srchilite
+t1 = time.perf_counter()
+print((t1 - t0) * 1e3)
+"""
+
+
+def time_import(n):
+    """Returns the times, in ms, of importing srchilite in n fresh processes"""
+    times = []
+    for _ in range(n):
+        out = subprocess.run([sys.executable, "-c", CHILD], check=True,
+                             stdout=subprocess.PIPE).stdout
+        times.append(float(out))
+    return sorted(times)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=20, help="number of imports")
+    parser.add_argument("--budget", type=float, default=IMPORT_BUDGET_MS,
+                        help="median import time budget, in ms")
+    parser.add_argument("-o", "--output", default="-",
+                        help="JSON file to write results to, '-' for stdout")
+    ns = parser.parse_args(args)
+    times = time_import(ns.n)
+    median = times[len(times) // 2]
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "n": ns.n,
+        "min_ms": times[0],
+        "median_ms": median,
+        "max_ms": times[-1],
+        "budget_ms": ns.budget,
+        "within_budget": median <= ns.budget,
+    }
+    if ns.output == "-":
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        with open(ns.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if not results["within_budget"]:
+        print("import srchilite took {0:.1f} ms, over the {1:.1f} ms budget".format(
+              median, ns.budget), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
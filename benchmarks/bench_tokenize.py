@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""Benchmarks tokenization throughput, latency, and memory use for each of the
+languages shipped in share/py-source-highlight, compared with the Pygments
+lexers that they were generated from. Results are written as JSON so that
+they may be compared between versions.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+import srchilite
+
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "share", "py-source-highlight")
+
+SAMPLES = {
+    "c": """\
+#include <stdio.h>
+/* a multiline
+   comment */
+static int count_lines(const char *s) {
+    int n = 0;  // the line count
+    while (*s) {
+        if (*s++ == '\\n') n++;
+    }
+    return n;
+}
+""",
+    "diff": """\
+--- a/srchilite/helpers.cpp
++++ b/srchilite/helpers.cpp
+@@ -1,5 +1,6 @@
+ #include <iostream>
++#include <sstream>
+ #include "srchilite/langdefmanager.h"
+-#include "srchilite/regexrulefactory.h"
++#include "srchilite/sourcehighlighter.h"
+""",
+    "ini": """\
+; a comment
+[section]
+key = value
+path = /usr/share/source-highlight
+# another comment
+[other.section]
+enabled=true
+""",
+    "pkgconfig": """\
+prefix=/usr
+libdir=${prefix}/lib
+includedir=${prefix}/include
+
+Name: source-highlight
+Description: GNU Source-highlight library
+Version: 3.1.9
+Libs: -L${libdir} -lsource-highlight
+Cflags: -I${includedir}
+""",
+}
+
+SNIPPETS = {
+    "c": "int x = f(1, \"two\"); // three\n",
+    "diff": "+#include <sstream>\n",
+    "ini": "key = value\n",
+    "pkgconfig": "Libs: -L${libdir} -lsource-highlight\n",
+}
+
+
+def lang_files():
+    """Returns a dict from language names to the shipped lang files."""
+    return {name: os.path.join(BASE_DIR, name + ".lang") for name in SAMPLES}
+
+
+def pygments_lexer(lang_file):
+    """Returns the Pygments lexer that a lang file was generated from."""
+    from pygments.lexers import get_lexer_by_name
+
+    with open(lang_file) as f:
+        header = f.readline()
+    _, _, name = header.strip().partition("autogenerated from pygments for ")
+    return get_lexer_by_name(name.lower())
+
+
+def make_code(lang, size):
+    """Repeats a language's sample until it is at least size bytes."""
+    sample = SAMPLES[lang]
+    return sample * (size // len(sample.encode()) + 1)
+
+
+def percentile(times, p):
+    times = sorted(times)
+    i = min(len(times) - 1, int(round(p / 100 * (len(times) - 1))))
+    return times[i]
+
+
+def bench_throughput(tokenize, code, repeat):
+    nbytes = len(code.encode())
+    best = float("inf")
+    ntokens = 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        ntokens = len(tokenize(code))
+        best = min(best, time.perf_counter() - t0)
+    return {
+        "bytes": nbytes,
+        "tokens": ntokens,
+        "seconds": best,
+        "mb_per_s": nbytes / best / 1e6,
+        "tokens_per_s": ntokens / best,
+    }
+
+
+def bench_latency(tokenize, snippet, n):
+    # warm up, so that loading the language is not counted
+    tokenize(snippet)
+    times = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        tokenize(snippet)
+        times.append(time.perf_counter() - t0)
+    return {
+        "n": n,
+        "p50_us": percentile(times, 50) * 1e6,
+        "p99_us": percentile(times, 99) * 1e6,
+    }
+
+
+def bench_peak_rss(lang, size, engine):
+    """Measures peak RSS in a fresh process, since peak RSS never goes down."""
+    cmd = [sys.executable, os.path.abspath(__file__), "--rss-child", lang,
+           str(size), engine]
+    out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(out)
+
+
+def rss_child(lang, size, engine):
+    import resource
+
+    code = make_code(lang, size)
+    lang_file = lang_files()[lang]
+    if engine == "pygments":
+        lexer = pygments_lexer(lang_file)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tokens = list(lexer.get_tokens(code))
+    else:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tokens = srchilite.get_tokens(code, filename=lang_file)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    scale = 1 if sys.platform == "darwin" else 1024
+    json.dump({"bytes": len(code.encode()), "tokens": len(tokens),
+               "peak_rss_bytes": after * scale,
+               "peak_rss_growth_bytes": (after - before) * scale}, sys.stdout)
+
+
+def tokenizers(lang_file, pygments=True):
+    rtn = {"srchilite": lambda code: srchilite.get_tokens(code, filename=lang_file)}
+    if pygments:
+        lexer = pygments_lexer(lang_file)
+        rtn["pygments"] = lambda code: list(lexer.get_tokens(code))
+    return rtn
+
+
+def run(langs, size, rss_size, repeat, n, pygments=True):
+    results = {
+        "version": srchilite.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "languages": {},
+    }
+    for lang in langs:
+        lang_file = lang_files()[lang]
+        code = make_code(lang, size)
+        lang_results = results["languages"][lang] = {}
+        for engine, tokenize in tokenizers(lang_file, pygments=pygments).items():
+            print("Benchmarking " + engine + " on " + lang, file=sys.stderr)
+            lang_results[engine] = {
+                "throughput": bench_throughput(tokenize, code, repeat),
+                "latency": bench_latency(tokenize, SNIPPETS[lang], n),
+                "memory": bench_peak_rss(lang, rss_size, engine),
+            }
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--langs", nargs="+", default=sorted(SAMPLES),
+                        choices=sorted(SAMPLES))
+    parser.add_argument("--size", type=int, default=1 << 20,
+                        help="bytes of code for throughput benchmarks")
+    parser.add_argument("--rss-size", type=int, default=1 << 24,
+                        help="bytes of code for peak memory benchmarks")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="throughput runs per language, the best is kept")
+    parser.add_argument("-n", type=int, default=2000,
+                        help="snippets per latency benchmark")
+    parser.add_argument("--no-pygments", dest="pygments", action="store_false",
+                        help="do not compare with Pygments")
+    parser.add_argument("-o", "--output", default="-",
+                        help="JSON file to write results to, '-' for stdout")
+    parser.add_argument("--rss-child", nargs=3, metavar=("LANG", "SIZE", "ENGINE"),
+                        help=argparse.SUPPRESS)
+    ns = parser.parse_args(args)
+    if ns.rss_child:
+        lang, size, engine = ns.rss_child
+        rss_child(lang, int(size), engine)
+        return
+    results = run(ns.langs, ns.size, ns.rss_size, ns.repeat, ns.n,
+                  pygments=ns.pygments)
+    if ns.output == "-":
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        with open(ns.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
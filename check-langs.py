@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""Checks generated languages for catastrophic backtracking. Worst-case
+inputs are built for each lang file from samples of its own regexes, and
+from shapes that are known to be pathological, such as unterminated comments
+and strings. Each input is highlighted at growing sizes, and a language is
+flagged if its highlighting time grows superlinearly with input size, or is
+too slow even at the smallest size. The exit status is non-zero when any
+language is flagged, so that this may be used as a gate when generating
+languages.
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+import subprocess
+from queue import Queue, Empty
+
+BASE_DIR = "share/py-source-highlight"
+# input sizes, in characters, that each shape is highlighted at
+SIZES = (1000, 2000, 4000, 8000, 16000)
+# the log-log slope of time against size that is flagged as superlinear
+MAX_SLOPE = 1.5
+# times below this, in seconds, are too noisy to fit a slope to
+MIN_SECONDS = 1e-3
+# stop growing a shape once highlighting it takes longer than this
+SHAPE_BUDGET = 1.0
+# seconds allowed for checking a single shape, at all of its sizes
+SHAPE_TIMEOUT = 60
+# the most regex samples to build shapes from, per language
+MAX_SAMPLES = 40
+
+REGEX_RE = re.compile(r"'((?:[^'\\\n]|\\.)+)'|`([^`]+)`")
+
+PATHOLOGICAL_SEEDS = (
+    "/*", "<!--", "(*", "{-", '"', "'", '"""', "`", "#", "//", "\\", "(",
+    "[", "{", "<", "$(", "${", "@", "0x", "1e", " ",
+)
+
+
+def lang_files(base_dir=BASE_DIR):
+    """Returns the sorted lang files that are named in the lang.map of
+    base_dir and exist.
+    """
+    fnames = set()
+    with open(os.path.join(base_dir, "lang.map")) as f:
+        for line in f:
+            _, sep, value = line.partition("=")
+            fname = os.path.join(base_dir, value.strip())
+            if sep and os.path.isfile(fname):
+                fnames.add(fname)
+    return sorted(fnames)
+
+
+def lang_regexes(fname):
+    """Returns the regexes that appear in a lang file"""
+    with open(fname, errors="surrogateescape") as f:
+        text = f.read()
+    regexes = []
+    for m in REGEX_RE.finditer(text):
+        regexes.append(m.group(1) or m.group(2))
+    return regexes
+
+
+def regex_samples(regexes, max_samples=MAX_SAMPLES):
+    """Returns strings matching the regexes, from exrex if it is installed,
+    longest first.
+    """
+    try:
+        import exrex
+    except ImportError:
+        return []
+    samples = set()
+    for regex in regexes:
+        try:
+            sample = exrex.getone(regex, 20)
+        except Exception:
+            continue
+        sample = sample.replace("\n", "").replace("\r", "")
+        if sample:
+            samples.add(sample)
+    return sorted(samples, key=lambda s: (-len(s), s))[:max_samples]
+
+
+def shapes(seeds):
+    """Yields (name, make) pairs, where make(n) returns an input of about n
+    characters built from a seed.
+    """
+    for seed in seeds:
+        yield ("repeat " + repr(seed),
+               lambda n, s=seed: s * (n // len(s) + 1))
+        yield ("unterminated " + repr(seed),
+               lambda n, s=seed: s + "a " * (n // 2))
+        yield ("unterminated escapes " + repr(seed),
+               lambda n, s=seed: s + "\\a" * (n // 2))
+        yield ("repeat lines " + repr(seed),
+               lambda n, s=seed: (s + "\n") * (n // (len(s) + 1) + 1))
+    yield ("spaces", lambda n: " " * n + "x")
+    yield ("word", lambda n: "a" * n)
+    yield ("nested parens", lambda n: "(" * (n // 2) + ")" * (n // 2))
+
+
+def slope(sizes, times):
+    """Returns the least squares slope of log(time) against log(size), using
+    only the times that are long enough to measure, or None.
+    """
+    points = [(math.log(n), math.log(t)) for n, t in zip(sizes, times)
+              if t >= MIN_SECONDS]
+    if len(points) < 2:
+        return None
+    mx = sum(x for x, _ in points) / len(points)
+    my = sum(y for _, y in points) / len(points)
+    sxx = sum((x - mx) ** 2 for x, _ in points)
+    if sxx == 0.0:
+        return None
+    return sum((x - mx) * (y - my) for x, y in points) / sxx
+
+
+def iter_check_lang(fname, sizes=SIZES, max_slope=MAX_SLOPE, on_start=None):
+    """Times highlighting every shape for a lang file at growing sizes,
+    yielding a (name, result) pair for each shape, where result is a dict of
+    the times, the slope, and whether the shape was flagged. A shape is
+    flagged if it grew superlinearly, or if even its smallest size took
+    longer than SHAPE_BUDGET. If given, on_start(name) is called before each
+    shape is timed.
+    """
+    from srchilite import Highlighter
+
+    path, filename = os.path.split(os.path.abspath(fname))
+    highlighter = Highlighter(filename=filename, path=path)
+    seeds = list(PATHOLOGICAL_SEEDS) + regex_samples(lang_regexes(fname))
+    for name, make in shapes(seeds):
+        if on_start is not None:
+            on_start(name)
+        times = []
+        for n in sizes:
+            code = make(n)
+            t0 = time.perf_counter()
+            highlighter.get_tokens(code)
+            times.append(time.perf_counter() - t0)
+            if times[-1] > SHAPE_BUDGET:
+                break
+        s = slope(sizes[:len(times)], times)
+        flagged = (s is not None and s > max_slope) or times[0] > SHAPE_BUDGET
+        yield name, {"seconds": times, "slope": s, "flagged": flagged}
+
+
+def check_lang(fname, sizes=SIZES, max_slope=MAX_SLOPE):
+    """Checks every shape for a lang file, and returns a dict of results,
+    with the shapes that were flagged.
+    """
+    results = {"lang": fname, "shapes": {}, "flagged": []}
+    for name, result in iter_check_lang(fname, sizes, max_slope):
+        results["shapes"][name] = result
+        if result["flagged"]:
+            results["flagged"].append(name)
+    return results
+
+
+def _read_lines(stream, queue):
+    for line in stream:
+        queue.put(line)
+    queue.put(None)
+
+
+def check_lang_in_child(fname, sizes, max_slope, timeout):
+    """Checks a lang file in a fresh process, since highlighting cannot be
+    interrupted once it has gone catastrophic. The child reports each shape
+    as it goes, and is killed if a single shape takes longer than timeout
+    seconds, keeping the results of the shapes before it.
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", fname,
+           "--sizes"] + [str(n) for n in sizes] + ["--max-slope", str(max_slope)]
+    results = {"lang": fname, "shapes": {}, "flagged": []}
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    queue = Queue()
+    reader = threading.Thread(target=_read_lines, args=(proc.stdout, queue),
+                              daemon=True)
+    reader.start()
+    current = None
+    killed = False
+    try:
+        while True:
+            try:
+                line = queue.get(timeout=timeout or None)
+            except Empty:
+                proc.kill()
+                killed = True
+                results["flagged"].append("timeout in " + str(current))
+                break
+            if line is None:
+                break
+            event = json.loads(line)
+            if "start" in event:
+                current = event["start"]
+                continue
+            results["shapes"][event["shape"]] = event["result"]
+            if event["result"]["flagged"]:
+                results["flagged"].append(event["shape"])
+    finally:
+        returncode = proc.wait()
+        proc.stdout.close()
+    if returncode and not killed:
+        results["flagged"].append("error, exit status {0}".format(returncode))
+    return results
+
+
+def run_child(fname, sizes, max_slope):
+    """Checks a lang file for check_lang_in_child(), writing a JSON line when
+    each shape starts and when it is done.
+    """
+    def on_start(name):
+        print(json.dumps({"start": name}), flush=True)
+
+    for name, result in iter_check_lang(fname, sizes, max_slope, on_start):
+        print(json.dumps({"shape": name, "result": result}), flush=True)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("langs", nargs="*",
+                        help="lang files to check, defaults to those in "
+                             + BASE_DIR + "/lang.map")
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(SIZES),
+                        help="input sizes to time each shape at")
+    parser.add_argument("--max-slope", type=float, default=MAX_SLOPE,
+                        help="log-log slope of time against size to flag")
+    parser.add_argument("--timeout", type=float, default=SHAPE_TIMEOUT,
+                        help="seconds allowed per shape, 0 for no limit")
+    parser.add_argument("-o", "--output", default=None,
+                        help="JSON file to write results to, '-' for stdout")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    ns = parser.parse_args(args)
+    if ns.child:
+        run_child(ns.child, ns.sizes, ns.max_slope)
+        return 0
+    results = []
+    for fname in ns.langs or lang_files():
+        print("Checking " + fname, file=sys.stderr)
+        result = check_lang_in_child(fname, ns.sizes, ns.max_slope, ns.timeout)
+        results.append(result)
+        for name in result["flagged"]:
+            print("  flagged: " + name, file=sys.stderr)
+    if ns.output == "-":
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    elif ns.output:
+        with open(ns.output, "w") as f:
+            json.dump(results, f, indent=1)
+    flagged = [r["lang"] for r in results if r["flagged"]]
+    if flagged:
+        print("Flagged languages: " + ", ".join(flagged), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
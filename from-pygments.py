@@ -5,12 +5,19 @@ source-highlight.
 import os
 import re
 import sys
+import json
 import time
+import hashlib
+import subprocess
 import inspect
+import argparse
+import functools
 import itertools
+import concurrent.futures
 from re import sre_parse
 from pprint import pprint
 
+import pygments
 from pygments import lexers
 from pygments import styles
 from pygments.lexer import words, default, using, this, DelegatingLexer, RegexLexer
@@ -22,6 +29,12 @@ from xonsh.color_tools import make_palette, find_closest_color, rgb_to_256
 
 
 BASE_DIR = "share/py-source-highlight"
+MANIFEST = "manifest.json"
+LEXER_TIMEOUT = 600
+# The most copies that a bounded repeat, like (?:a){0,5}, may be expanded into
+MAX_REPEAT_EXPANSION = 101
+# The most branches that expanding (?:a|b) groups into their product may make
+MAX_BRANCH_EXPANSION = 256
 CURRENT_LEXER = None
 LEXER_STACK = None
 
@@ -62,6 +75,7 @@ def exrex_safe(s):
     return s.replace("*?", "{0,100}").replace("+?", "{1,100}")
 
 
+@functools.lru_cache(maxsize=None)
 def longest_sample(regex, n=100, limit=100):
     regex = exrex_safe(regex)
     s = ""
@@ -97,6 +111,13 @@ def getone_match(regex, n=None, replace_newlines=True):
 
 
 def get_match(regex):
+    # samples are shorter for some lexers, see GETONE_MATCH_LENGTH
+    name = None if CURRENT_LEXER is None else CURRENT_LEXER.name
+    return _get_match(name, regex)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_match(lexer_name, regex):
     sample = longest_sample(regex)
     m = re.match(regex, sample)
     if m is not None:
@@ -127,6 +148,12 @@ def token_from_using(callback, regex):
 UNCAPTURED_GROUP_PREFIXES = ["(?:", "(?=", "(?!", "(?<=", "(?<!"]
 
 
+class ExpansionLimitError(ValueError):
+    """Raised when removing non-capturing groups from a regex would expand it
+    past MAX_BRANCH_EXPANSION branches.
+    """
+
+
 class EchoTranslator:
     """Translates regexes into the same regex, useful for
     subclassing only a part of the regex.
@@ -330,7 +357,7 @@ def remove_noncapturing_transform(s, ret=None):
                     sub = list(parts[0][1][2][0][1][3])
                     low = parts[0][1][0]
                     high = parts[0][1][1] + 1
-                    if high < 102:
+                    if high <= MAX_REPEAT_EXPANSION:
                         branches = [sub * n for n in range(low, high)]
                         parts = [(sre_parse.BRANCH, (None, branches))]
                 elif (
@@ -341,7 +368,7 @@ def remove_noncapturing_transform(s, ret=None):
                     sub = list(parts[0][1][2])
                     low = parts[0][1][0]
                     high = parts[0][1][1] + 1
-                    if high < 102:
+                    if high <= MAX_REPEAT_EXPANSION:
                         branches = [sub * n for n in range(low, high)]
                         parts = [(sre_parse.BRANCH, (None, branches))]
                 ret.append((sre_parse.SUBPATTERN, (i[1][0], i[1][1], i[1][2], parts)))
@@ -438,8 +465,15 @@ def remove_noncapturing_transform(s, ret=None):
             ret.append(i)
     # OK do the expansions
     if need_to_expand:
+        nparts = 1
+        for branches in expansions.values():
+            nparts *= len(branches)
+        if nparts > MAX_BRANCH_EXPANSION:
+            raise ExpansionLimitError(
+                f"expanding would make {nparts} branches, more than "
+                f"MAX_BRANCH_EXPANSION={MAX_BRANCH_EXPANSION}"
+            )
         iters = []
-        ntimes = max(map(len, expansions.values()))
         for i in ret:
             if isinstance(i, int):
                 iters.append(expansions[i])
@@ -458,14 +492,34 @@ def remove_noncapturing_transform(s, ret=None):
     return ret
 
 
+@functools.lru_cache(maxsize=None)
 def remove_noncapturing(s):
     sre_obj = remove_noncapturing_transform(s)
     ret = noncapturing_translate(sre_obj)
     return ret
 
 
+BYGROUP_CACHE = {}
+
+
 def bygroup_translator(regex, bg, **kwargs):
     tokens = inspect.getclosurevars(bg).nonlocals["args"]
+    # using() tokens depend on the current lexer
+    name = None if CURRENT_LEXER is None else CURRENT_LEXER.name
+    key = (name, regex, tokens)
+    if key not in BYGROUP_CACHE:
+        BYGROUP_CACHE[key] = _bygroup_translator(regex, tokens)
+    return BYGROUP_CACHE[key]
+
+
+def _plain_token_name(token_names):
+    for name in token_names:
+        if name not in ("Token_Text", "Token_Text_Whitespace"):
+            return name
+    return token_names[0] if token_names else "Token_Text"
+
+
+def _bygroup_translator(regex, tokens):
     token_names = []
     for i, token in enumerate(tokens):
         if token in Token:
@@ -480,6 +534,11 @@ def bygroup_translator(regex, bg, **kwargs):
         regex = regex[1:]
     try:
         regex = remove_noncapturing(regex)
+    except ExpansionLimitError as e:
+        # too big to split into groups, so highlight the match as one token
+        sys.stdout.flush()
+        print(f"plain rule for {orig_regex!r}, {e}", file=sys.stderr, flush=True)
+        return _plain_token_name(token_names) + " = '" + quote_safe(regex) + "'"
     except Exception:
         print(f"Original Regex is: {orig_regex!r}")
         raise
@@ -668,7 +727,41 @@ def return_to_root(lines, indent):
         lines.append(indent + "exitall")
 
 
+# Memo of generated state bodies, from (lexer type, state key, stack, lexer
+# stack types) to [lines dedented to level 0, stack afterwards, uses]
+STATE_MEMO = {}
+
+
+def _dedent(lines, indent):
+    n = len(indent)
+    return [line[n:] if line.startswith(indent) else line for line in lines]
+
+
 def genrulelines(lexer, state_key="root", level=0, stack=None, elems=None):
+    """Returns the rule lines for a state of a lexer. A state reached along
+    many paths is only generated once for each stack of states it may be
+    entered with, and copied from STATE_MEMO after that.
+    """
+    if elems is not None:
+        return _genrulelines(lexer, state_key=state_key, level=level,
+                             stack=stack, elems=elems)
+    stack = ["root"] if stack is None else stack
+    key = (type(lexer), state_key, tuple(stack),
+           tuple(type(lxr) for lxr in LEXER_STACK or ()))
+    indent = "  " * level
+    entry = STATE_MEMO.get(key, None)
+    if entry is None:
+        lines = list(_genrulelines(lexer, state_key=state_key, level=level,
+                                   stack=stack))
+        entry = STATE_MEMO[key] = [_dedent(lines, indent), tuple(stack), 0]
+    else:
+        # replay what generating the state would have done to the stack
+        stack[:] = entry[1]
+    entry[2] += 1
+    return [indent + line for line in entry[0]]
+
+
+def _genrulelines(lexer, state_key="root", level=0, stack=None, elems=None):
     global LEXER_STACK
     lines = []
     indent = "  " * level
@@ -813,15 +906,346 @@ def genrulelines(lexer, state_key="root", level=0, stack=None, elems=None):
     return lines
 
 
+#
+# Optimizer
+#
+
+SIMPLE_RULE_RE = re.compile(
+    r"^(?P<indent>\s*)(?P<token>\w+) = '(?P<regex>.*)'(?P<suffix>(?: exit(?: \d+)?| exitall)?)$",
+    re.DOTALL,
+)
+STATE_RULE_RE = re.compile(r"^\s*state (?P<token>\w+) = '(?P<regex>.*)' .*begin$", re.DOTALL)
+EXIT_LINE_RE = re.compile(r"^\s*(?P<exit>exit(?: \d+)?|exitall)\s*$")
+# The most words that a regex may be expanded into to build a trie from it
+MAX_TRIE_WORDS = 1000
+
+
+def _literal_words(items):
+    words = [""]
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            alts = [chr(av)]
+        elif op == sre_parse.IN:
+            if any(o != sre_parse.LITERAL for o, _ in av):
+                return None
+            alts = [chr(a) for _, a in av]
+        elif op == sre_parse.SUBPATTERN:
+            if av[1] or av[2]:
+                # scoped flags, like (?i:...), change what the words match
+                return None
+            alts = _literal_words(av[3])
+        elif op == sre_parse.MAX_REPEAT and av[:2] == (0, 1):
+            # optional parts, as made by trie_regex()
+            alts = _literal_words(av[2])
+            if alts is not None:
+                alts = [""] + alts
+        elif op == sre_parse.BRANCH:
+            alts = []
+            for branch in av[1]:
+                sub = _literal_words(branch)
+                if sub is None:
+                    return None
+                alts.extend(sub)
+        else:
+            return None
+        if alts is None or not all(c.isalnum() or c == "_" for c in "".join(alts)):
+            return None
+        words = [w + a for w in words for a in alts]
+        if len(words) > MAX_TRIE_WORDS:
+            return None
+    return words
+
+
+def literal_words(regex):
+    """Returns the list of words that a regex made only of word characters,
+    groups, and alternations matches, or None if it is any other kind of
+    regex, or if it sets any flags.
+    """
+    try:
+        parsed = sre_parse.parse(regex)
+    except Exception:
+        return None
+    if parsed.state.flags & ~sre_parse.SRE_FLAG_UNICODE:
+        # global flags, like (?i), change what the words match
+        return None
+    return _literal_words(parsed)
+
+
+def word_rule(regex):
+    """Splits a regex that matches a list of words, between optional word
+    boundaries, into a (lead, words, trail) tuple, where lead and trail are
+    either '\\b' or ''. Returns None if the regex is anything else.
+    """
+    lead = trail = ""
+    if regex.startswith("\\b"):
+        lead, regex = regex[:2], regex[2:]
+    if regex.endswith("\\b") and not regex.endswith("\\\\b"):
+        regex, trail = regex[:-2], regex[-2:]
+    words = literal_words(regex)
+    if not words or "" in words:
+        return None
+    return lead, frozenset(words), trail
+
+
+def _trie_to_regex(node):
+    alts = [re.escape(c) + _trie_to_regex(node[c]) for c in sorted(node) if c]
+    if not alts:
+        return ""
+    elif len(alts) == 1 and "" not in node:
+        return alts[0]
+    regex = "(?:" + "|".join(alts) + ")"
+    if "" in node:
+        regex += "?"
+    return regex
+
+
+def trie_regex(words):
+    """Returns a regex matching the same words, factored into a trie so that
+    the regex engine never has to try more than one branch per character.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[""] = True
+    return _trie_to_regex(trie)
+
+
+def keyword_trie(regex):
+    """Rewrites regexes that match a list of words followed by a word boundary,
+    such as '__(event|interface)\\b', into trie form. Other regexes are returned
+    unchanged. Since every word must run up to the boundary, at most one word
+    can match at any position, so the order of the words does not matter.
+    """
+    rule = word_rule(regex)
+    if rule is None or not rule[2] or len(rule[1]) < 2:
+        return regex
+    lead, words, trail = rule
+    return lead + trie_regex(words) + trail
+
+
+def _prefix_free(words):
+    return not any(a != b and a.startswith(b) for a in words for b in words)
+
+
+def _merge_rules(lines):
+    # Adjacent rules for the same token are merged into a single trie, but
+    # only when both are word lists that can never match at the same
+    # position, so that it does not matter how source-highlight breaks ties
+    # between rules, i.e. by order or by length. This is the case when both
+    # end in a word boundary, since the words must then run up to the same
+    # place, or when no word of either rule is a prefix of another word, which
+    # also keeps the trie from preferring a longer word than the rule did.
+    out = []
+    prev = None
+    for line in _join_exits(lines):
+        m = SIMPLE_RULE_RE.match(line)
+        rule = None if m is None or m.group("suffix") else word_rule(m.group("regex"))
+        if rule is None:
+            prev = None
+            out.append(line)
+            continue
+        if (prev is not None and prev[0].group("indent") == m.group("indent")
+                and prev[0].group("token") == m.group("token")
+                and prev[1][0] == rule[0] and prev[1][2] == rule[2]
+                and (rule[2] or _prefix_free(prev[1][1] | rule[1]))):
+            rule = (rule[0], prev[1][1] | rule[1], rule[2])
+            regex = rule[0] + trie_regex(rule[1]) + rule[2]
+            out[-1] = m.group("indent") + m.group("token") + " = '" + regex + "'"
+            m = SIMPLE_RULE_RE.match(out[-1])
+        else:
+            out.append(line)
+        prev = (m, rule)
+    return out
+
+
+def _shadows(rule, other):
+    """Whether a word rule always matches, with the same length, wherever a
+    later word rule would, so that the later one can never be chosen.
+    """
+    return (rule[2] and other[2] and rule[1] >= other[1]
+            and (not rule[0] or other[0]))
+
+
+def _optimize_state(lines, i):
+    out = []
+    seen = set()
+    word_rules = []
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        if stripped == "end":
+            break
+        elif stripped.endswith(" begin"):
+            m = STATE_RULE_RE.match(line)
+            if m is not None:
+                seen.add(m.group("regex"))
+                rule = word_rule(m.group("regex"))
+                if rule is not None:
+                    word_rules.append(rule)
+            body, i = _optimize_state(lines, i + 1)
+            out.append(line)
+            out.extend(body)
+            if i < len(lines):
+                out.append(lines[i])
+            i += 1
+            continue
+        m = SIMPLE_RULE_RE.match(line)
+        if m is not None:
+            regex = m.group("regex")
+            rule = word_rule(regex)
+            if regex in seen or (rule is not None and any(
+                    _shadows(r, rule) for r in word_rules)):
+                # an earlier rule matches the same text first
+                i += 1
+                continue
+            seen.add(regex)
+            if rule is not None:
+                word_rules.append(rule)
+            line = (m.group("indent") + m.group("token") + " = '"
+                    + keyword_trie(regex) + "'" + m.group("suffix"))
+        out.append(line)
+        i += 1
+    return _merge_rules(out), i
+
+
+def _join_exits(lines):
+    # source-highlight's grammar is free-form, so an exit on a line of its
+    # own, as made by return_to_root(), belongs to the rule before it. It is
+    # joined onto that rule, so that the rule is kept whole when rules are
+    # removed or merged.
+    out = []
+    for line in lines:
+        m = EXIT_LINE_RE.match(line)
+        if m is not None:
+            j = len(out) - 1
+            while j >= 0 and out[j].lstrip().startswith("#"):
+                j -= 1
+            prev = SIMPLE_RULE_RE.match(out[j]) if j >= 0 else None
+            if prev is not None and not prev.group("suffix"):
+                out[j] += " " + m.group("exit")
+                continue
+        out.append(line)
+    return out
+
+
+def optimize_lines(lines):
+    """Optimizes the rule lines of a lang file, state by state. Rules that
+    can never match are removed, i.e. those whose regex already appeared
+    earlier in the same state, and keyword lists whose words all appeared in
+    an earlier keyword list of the state. Word lists are rewritten as tries,
+    and adjacent word lists for the same token are merged where that cannot
+    change which rule matches.
+    """
+    lines, _ = _optimize_state(_join_exits(lines), 0)
+    return lines
+
+
+#
+# Shared states
+#
+
+# The fewest lines that a repeated state body must have to be moved into an
+# include file of its own
+SHARED_STATE_MIN_LINES = 4
+
+
+def _balanced(lines):
+    depth = 0
+    for line in lines:
+        stripped = line.strip()
+        if stripped.endswith(" begin"):
+            depth += 1
+        elif stripped == "end":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+def _replace_block(lines, body, include):
+    """Replaces each occurrence of body in lines, ignoring indentation, with
+    an include line. Returns the new lines and the number of occurrences.
+    """
+    keys = [line.lstrip(" ") for line in body]
+    n = len(keys)
+    out = []
+    count = 0
+    i = 0
+    while i < len(lines):
+        if (lines[i].lstrip(" ") == keys[0]
+                and [line.lstrip(" ") for line in lines[i:i + n]] == keys):
+            indent = lines[i][:len(lines[i]) - len(keys[0])]
+            out.append(indent + include)
+            count += 1
+            i += n
+        else:
+            out.append(lines[i])
+            i += 1
+    return out, count
+
+
+def share_repeated_states(lines, prefix):
+    """Moves the bodies of states that STATE_MEMO saw generated more than
+    once, and that still appear more than once in lines, into include files.
+    source-highlight includes are textual, so this shrinks the lang files but
+    not the loaded highlighter. Returns the new lines and a dict of include
+    file names to their lines.
+    """
+    candidates = set()
+    for body, _, uses in STATE_MEMO.values():
+        if uses < 2 or len(body) < SHARED_STATE_MIN_LINES:
+            continue
+        body = tuple(optimize_lines(body))
+        if len(body) >= SHARED_STATE_MIN_LINES and _balanced(body):
+            candidates.add(body)
+    includes = {}
+    for body in sorted(candidates, key=len, reverse=True):
+        digest = hashlib.sha256("\n".join(body).encode()).hexdigest()[:12]
+        name = prefix + "-" + digest + ".lang"
+        include = 'include "' + name + '"'
+        new_lines, count = _replace_block(lines, body, include)
+        new_includes = {}
+        for fname, inc_lines in includes.items():
+            new_includes[fname], n = _replace_block(inc_lines, body, include)
+            count += n
+        if count < 2:
+            continue
+        lines = new_lines
+        includes = new_includes
+        includes[name] = list(body)
+    return lines, includes
+
+
 def genlang(lexer):
+    STATE_MEMO.clear()
     lines = ["# autogenerated from pygments for " + lexer.name]
-    lines.extend(genrulelines(lexer))
-    lang = "\n".join(lines) + "\n"
+    rules = list(genrulelines(lexer))
+    optimized = optimize_lines(rules)
+    print(f"Optimized {lexer.name} from {len(rules)} to {len(optimized)} lines")
     norm_name = lexer.name.lower().replace(" ", "-").replace("+", "").replace("/", "")
+    shared, includes = share_repeated_states(optimized, norm_name)
+    lines.extend(shared)
+    lang = "\n".join(lines) + "\n"
+    nbytes = len(lang)
+    # includes are written first, so that the lang file never names a
+    # missing one
+    for name, inc_lines in includes.items():
+        inc = "# autogenerated from pygments for " + lexer.name + "\n"
+        inc += "\n".join(inc_lines) + "\n"
+        with open(os.path.join(BASE_DIR, name), "w", errors="backslashreplace") as f:
+            f.write(inc)
+        nbytes += len(inc)
     fname = os.path.join(BASE_DIR, norm_name + ".lang")
     with open(fname, "w", errors="backslashreplace") as f:
         f.write(lang)
-    return fname
+    if includes:
+        full = len("\n".join(optimized)) + 1
+        print(f"Shared {len(includes)} states of {lexer.name} in include files, "
+              f"{full} -> {nbytes} bytes")
+    STATE_MEMO.clear()
+    return fname, sorted(includes)
 
 
 def add_to_lang_map(lexer, base, lang_map):
@@ -873,13 +1297,220 @@ def get_lexer_from_lookup(name, lookups):
     raise RuntimeError("could not find lexer " + name)
 
 
-def genlangs():
-    global CURRENT_LEXER, LEXER_STACK
-    # lexer_names = ["ActionScript3", "diff", "ini", "pkgconfig", "c"]
-    # lexer_names = ["adl"]
-    lexer_lookups = {x[0]: x for x in lexers.get_all_lexers()}
-    lexer_names = list(lexer_lookups.keys())
+def _hash_files(fnames):
+    h = hashlib.sha256()
+    for fname in sorted(fnames):
+        with open(fname, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def generator_hash():
+    """Hash of this generator's own source"""
+    return _hash_files([os.path.abspath(__file__)])
+
+
+def _using_lexer_classes(action):
+    """Yields the lexer classes that a rule's callback hands its match to with
+    using(), including those nested in bygroups().
+    """
+    try:
+        nonlocals = inspect.getclosurevars(action).nonlocals
+    except TypeError:
+        return
+    other = nonlocals.get("_other", None)
+    if isinstance(other, type):
+        yield other
+    for arg in nonlocals.get("args", ()):
+        if callable(arg):
+            yield from _using_lexer_classes(arg)
+
+
+def lexer_source_files(lexer):
+    """Returns the set of source files that a lexer's rules may come from,
+    i.e. the modules of all of its classes, and those of the lexers that it
+    delegates to, either as a DelegatingLexer or with using().
+    """
+    lxrs = [lexer]
+    seen = set()
+    fnames = set()
+    while lxrs:
+        lxr = lxrs.pop()
+        if type(lxr) in seen:
+            continue
+        seen.add(type(lxr))
+        if isinstance(lxr, DelegatingLexer):
+            lxrs.extend([lxr.root_lexer, lxr.language_lexer])
+        for state in getattr(lxr, "_tokens", {}).values():
+            for rule in state:
+                lxrs.extend(cls() for cls in _using_lexer_classes(rule[1])
+                            if cls not in seen)
+        for cls in type(lxr).__mro__:
+            if cls is object:
+                continue
+            try:
+                fnames.add(inspect.getsourcefile(cls))
+            except TypeError:
+                pass
+    fnames.discard(None)
+    return fnames
+
+
+def lexer_hash(lexer, gen_hash):
+    """Hash of everything that the lang file for a lexer depends on,
+    including the expansion limits that it was generated with.
+    """
+    h = hashlib.sha256()
+    h.update(gen_hash.encode())
+    h.update(pygments.__version__.encode())
+    h.update("{0} {1}".format(MAX_REPEAT_EXPANSION,
+                              MAX_BRANCH_EXPANSION).encode())
+    h.update(_hash_files(lexer_source_files(lexer)).encode())
+    return h.hexdigest()
+
+
+def read_manifest():
+    fname = os.path.join(BASE_DIR, MANIFEST)
+    if not os.path.isfile(fname):
+        return {"lexers": {}}
+    with open(fname) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest):
+    fname = os.path.join(BASE_DIR, MANIFEST)
+    tmp = fname + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp, fname)
+
+
+_LEXER_LOOKUPS = None
+
+
+def _init_worker(max_repeat_expansion, max_branch_expansion):
+    global MAX_REPEAT_EXPANSION, MAX_BRANCH_EXPANSION
+    MAX_REPEAT_EXPANSION = max_repeat_expansion
+    MAX_BRANCH_EXPANSION = max_branch_expansion
+
+
+def genlang_job(lexer_name):
+    """Generates the lang file for a single lexer, in a worker process.
+    Returns (lexer_name, base, includes, lang_map, error), where includes
+    are the names of the include files that the lang file uses, and error is
+    None on success.
+    """
+    global CURRENT_LEXER, LEXER_STACK, _LEXER_LOOKUPS
+    if _LEXER_LOOKUPS is None:
+        _LEXER_LOOKUPS = {x[0]: x for x in lexers.get_all_lexers()}
+    try:
+        lexer = get_lexer_from_lookup(lexer_name, _LEXER_LOOKUPS)
+        CURRENT_LEXER = lexer
+        LEXER_STACK = [lexer]
+        fname, includes = genlang(lexer)
+    except Exception as e:
+        return lexer_name, None, None, None, "{0}: {1}".format(
+            type(e).__name__, e)
+    finally:
+        CURRENT_LEXER = None
+    base = os.path.basename(fname)
     lang_map = {}
+    add_to_lang_map(lexer, base, lang_map)
+    return lexer_name, base, includes, lang_map, None
+
+
+def _kill_executor(executor):
+    """Shuts down a process pool without waiting for its running jobs,
+    killing its workers, since they may be stuck in C code.
+    """
+    # there is no public way to reach the workers before Python 3.14
+    processes = list((getattr(executor, "_processes", None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.kill()
+
+
+def run_genlang_jobs(lexer_names, jobs=None, timeout=LEXER_TIMEOUT):
+    """Yields the results of genlang_job() for the lexers, run on a pool of
+    jobs processes. At most one lexer is given to each worker at a time, so
+    that a lexer's time starts when it is submitted. A lexer that takes longer
+    than timeout seconds yields a TimeoutError. Its worker cannot be
+    interrupted, so the pool is killed and replaced, and the lexers that were
+    still running on it are started again.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    initargs = (MAX_REPEAT_EXPANSION, MAX_BRANCH_EXPANSION)
+    todo = list(reversed(lexer_names))
+    running = {}
+    executor = None
+    try:
+        while todo or running:
+            if executor is None:
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=jobs, initializer=_init_worker,
+                    initargs=initargs)
+            while todo and len(running) < jobs:
+                lexer_name = todo.pop()
+                deadline = time.monotonic() + timeout if timeout else None
+                future = executor.submit(genlang_job, lexer_name)
+                running[future] = (lexer_name, deadline)
+            wait = None
+            if timeout:
+                first = min(deadline for _, deadline in running.values())
+                wait = max(0.0, first - time.monotonic())
+            done, _ = concurrent.futures.wait(
+                running, timeout=wait,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                lexer_name, _ = running.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    # a worker that crashed breaks the whole pool
+                    yield lexer_name, None, None, None, "{0}: {1}".format(
+                        type(e).__name__, e)
+            now = time.monotonic()
+            expired = [future for future, (_, deadline) in running.items()
+                       if deadline is not None and deadline <= now]
+            if not expired:
+                continue
+            for future in expired:
+                lexer_name, _ = running.pop(future)
+                yield lexer_name, None, None, None, \
+                    "TimeoutError: timed out after {0} s".format(timeout)
+            _kill_executor(executor)
+            executor = None
+            todo.extend(lexer_name for lexer_name, _ in running.values())
+            running.clear()
+    finally:
+        if executor is not None and running:
+            _kill_executor(executor)
+        elif executor is not None:
+            executor.shutdown()
+
+
+def _entry_files(entry):
+    return [entry["file"]] + entry.get("includes", [])
+
+
+def genlangs(jobs=None, timeout=LEXER_TIMEOUT, force=False, lexer_names=None):
+    """Generates lang files for all of the Pygments regex lexers, spread over
+    a pool of jobs processes. A lexer is only regenerated if its hash in the
+    manifest, which covers its source, the Pygments version, and this
+    generator, has changed, or if any of its files are missing. Lexers that
+    take longer than timeout seconds are skipped, keeping whatever they had
+    before. Include files that no lexer uses any more are removed. Returns the
+    generated lang files and the names of the lexers that failed.
+    """
+    lexer_lookups = {x[0]: x for x in lexers.get_all_lexers()}
+    if lexer_names is None:
+        lexer_names = list(lexer_lookups.keys())
+    manifest = read_manifest()
+    entries = manifest["lexers"]
+    gen_hash = generator_hash()
+    todo = {}
+    up_to_date = 0
     for lexer_name in lexer_names:
         lexer = get_lexer_from_lookup(lexer_name, lexer_lookups)
         if not isinstance(lexer, (RegexLexer, DelegatingLexer)):
@@ -888,14 +1519,54 @@ def genlangs():
                 "a RegexLexer or Delegating lexer."
             )
             continue
-        print("Generating lexer " + lexer_name)
-        CURRENT_LEXER = lexer
-        LEXER_STACK = [lexer]
-        fname = genlang(lexer)
-        base = os.path.basename(fname)
-        add_to_lang_map(lexer, base, lang_map)
-    CURRENT_LEXER = None
+        key = lexer_hash(lexer, gen_hash)
+        entry = entries.get(lexer_name, None)
+        if (not force and entry is not None and entry["hash"] == key
+                and all(os.path.isfile(os.path.join(BASE_DIR, name))
+                        for name in _entry_files(entry))):
+            up_to_date += 1
+            continue
+        todo[lexer_name] = key
+    print("Generating {0} lexers, {1} up to date".format(
+          len(todo), up_to_date))
+    generated = []
+    failed = []
+    replaced = set()
+    for lexer_name, base, includes, lang_map, error in run_genlang_jobs(
+            list(todo), jobs=jobs, timeout=timeout):
+        if error is not None:
+            print("Failed lexer " + lexer_name + ", " + error)
+            failed.append(lexer_name)
+            continue
+        print("Generated lexer " + lexer_name)
+        generated.append(os.path.join(BASE_DIR, base))
+        if lexer_name in entries:
+            replaced.update(entries[lexer_name].get("includes", []))
+        entries[lexer_name] = {"hash": todo[lexer_name], "file": base,
+                               "includes": includes, "lang_map": lang_map}
+        # written as we go, so that an interrupted run keeps its progress
+        write_manifest(manifest)
+    # only includes that the manifest once listed are removed, never
+    # hand-written lang files
+    used = {name for entry in entries.values() for name in _entry_files(entry)}
+    for name in sorted(replaced - used):
+        fname = os.path.join(BASE_DIR, name)
+        if os.path.isfile(fname):
+            print("Removing unused include " + name)
+            os.remove(fname)
+    lang_map = {}
+    for lexer_name in sorted(entries):
+        lang_map.update(entries[lexer_name]["lang_map"])
     write_lang_map(lang_map)
+    return generated, failed
+
+
+def check_langs(fnames):
+    """Runs check-langs.py on lang files, returning whether they all passed"""
+    if not fnames:
+        return True
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "check-langs.py")
+    return subprocess.run([sys.executable, script] + fnames).returncode == 0
 
 
 #
@@ -1034,8 +1705,35 @@ def genstyles():
 
 
 def main(args=None):
-    genlangs()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of processes, defaults to the CPU count")
+    parser.add_argument("--timeout", type=int, default=LEXER_TIMEOUT,
+                        help="seconds allowed per lexer, 0 for no limit")
+    parser.add_argument("--force", action="store_true",
+                        help="regenerate lexers even if they are up to date")
+    parser.add_argument("--lexers", nargs="+", default=None,
+                        help="names of the lexers to generate")
+    parser.add_argument("--max-repeat-expansion", type=int,
+                        default=MAX_REPEAT_EXPANSION,
+                        help="most copies a bounded repeat is expanded into")
+    parser.add_argument("--max-branch-expansion", type=int,
+                        default=MAX_BRANCH_EXPANSION,
+                        help="most branches a non-capturing group expansion "
+                             "may make before falling back to a plain rule")
+    parser.add_argument("--check", action="store_true",
+                        help="check the generated languages for superlinear "
+                             "highlighting time with check-langs.py")
+    ns = parser.parse_args(args)
+    _init_worker(ns.max_repeat_expansion, ns.max_branch_expansion)
+    generated, failed = genlangs(jobs=ns.jobs, timeout=ns.timeout,
+                                 force=ns.force, lexer_names=ns.lexers)
     genstyles()
+    if failed:
+        print("Failed lexers: " + ", ".join(sorted(failed)))
+    if ns.check and not check_langs(generated):
+        return 1
+    return 0
 
 
 def test():
@@ -1054,5 +1752,5 @@ def test():
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
     # test()
@@ -1,9 +1,30 @@
 from srchilite.bindings import (
     LangMap,
     get_tokens,
+    get_tokens_many,
+    iter_tokens,
+    get_token_array,
+    highlight_file,
+    guess_lang,
+    highlight,
+    get_renderer,
+    Renderer,
+    TokenArray,
+    TOKEN_TYPES,
+    get_highlighter,
+    preload,
+    stats,
+    enable_stats,
+    disable_stats,
+    reset_stats,
+    enable_memo,
+    disable_memo,
+    Highlighter,
+    Document,
     Token,
     LANG_MAP_CACHE,
     PY_SOURCE_HIGHLIGHT_PATH,
 )
+from srchilite.parallel import highlight_paths
 
 __version__ = "0.0.0"
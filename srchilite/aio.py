@@ -0,0 +1,183 @@
+"""An asyncio interface to highlighting. Highlighting runs on a dedicated
+thread pool, so that it never blocks the event loop, with a bound on how many
+highlighting jobs may run at once. Large documents are highlighted in chunks
+of lines, each of which is a separate job, so that one huge document cannot
+starve small requests.
+"""
+import io
+import os
+import asyncio
+import itertools
+import functools
+import weakref
+
+from srchilite import bindings
+
+
+class AsyncHighlighter:
+    """Runs highlighting for asyncio on a dedicated executor.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        The number of threads in the executor.
+    concurrency : int, optional
+        The most highlighting jobs that may be running or queued on the
+        executor at once. Defaults to max_workers.
+    queue_size : int, optional
+        The most chunks of tokens that aiter_tokens() will highlight ahead of
+        its consumer.
+    chunk_lines : int, optional
+        The number of lines highlighted per job by aiter_tokens().
+    """
+
+    def __init__(self, max_workers=None, concurrency=None, queue_size=4,
+                 chunk_lines=256):
+        self.max_workers = max_workers or min(32, os.cpu_count() or 1)
+        self.concurrency = concurrency or self.max_workers
+        self.queue_size = queue_size
+        self.chunk_lines = chunk_lines
+        self._executor = None
+        # asyncio semaphores may only be used within a single event loop
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    @property
+    def executor(self):
+        """The thread pool that highlighting runs on"""
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix="srchilite")
+        return self._executor
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        sem = self._semaphores.get(loop, None)
+        if sem is None:
+            sem = self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return sem
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        sem = self._semaphore()
+        await sem.acquire()
+        try:
+            future = self.executor.submit(functools.partial(func, *args, **kwargs))
+        except BaseException:
+            sem.release()
+            raise
+
+        def release(_):
+            try:
+                loop.call_soon_threadsafe(sem.release)
+            except RuntimeError:
+                # the loop is already closed
+                pass
+
+        # the semaphore is held until the job itself is done, even if the
+        # caller is cancelled while the job is still running
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future, loop=loop)
+
+    async def aget_tokens(self, code, lang="", filename="", path=None):
+        """Returns token list from code in a given language, like get_tokens().
+        If this is cancelled, a highlighting job that is already running
+        finishes, and counts against the concurrency limit until it does, but
+        its result is dropped.
+        """
+        return await self._run(bindings.get_tokens, code, lang=lang,
+                               filename=filename, path=path)
+
+    async def aiter_tokens(self, lines, lang="", filename="", path=None):
+        """Asynchronous generator that yields tokens from code, or an iterable
+        of lines such as a file-like object, in a given language. Lines are
+        read and highlighted chunk_lines at a time on the executor, with at
+        most queue_size chunks waiting on the consumer.
+        """
+        if isinstance(lines, str):
+            lines = io.StringIO(lines)
+        # loading a language may take a while, so it is kept off of the loop
+        highlighter = await self._run(bindings.get_highlighter, lang=lang,
+                                      filename=filename, path=path)
+        stream = bindings._LineStream(highlighter)
+        line_iter = bindings._iter_lines(lines)
+        chunk_lines = self.chunk_lines
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        done = object()
+
+        def highlight_chunk():
+            tokens = []
+            for line in itertools.islice(line_iter, chunk_lines):
+                tokens.extend(stream.highlight_line(line))
+            return tokens
+
+        async def produce():
+            try:
+                while True:
+                    tokens = await self._run(highlight_chunk)
+                    if not tokens:
+                        break
+                    await queue.put(tokens)
+            except Exception as e:
+                await queue.put(e)
+            else:
+                await queue.put(done)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+                for token in item:
+                    yield token
+        finally:
+            # stops highlighting when the consumer stops or is cancelled
+            producer.cancel()
+
+    def shutdown(self, wait=True):
+        """Shuts down the executor"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+_DEFAULT = None
+
+
+def get_default():
+    """Returns the default AsyncHighlighter"""
+    global _DEFAULT
+    if _DEFAULT is None:
+        _DEFAULT = AsyncHighlighter()
+    return _DEFAULT
+
+
+def configure(**kwargs):
+    """Replaces the default AsyncHighlighter with one made from the given
+    keyword arguments, and returns it.
+    """
+    global _DEFAULT
+    if _DEFAULT is not None:
+        _DEFAULT.shutdown(wait=False)
+    _DEFAULT = AsyncHighlighter(**kwargs)
+    return _DEFAULT
+
+
+async def aget_tokens(code, lang="", filename="", path=None):
+    """Returns token list from code in a given language, highlighting it on
+    the default AsyncHighlighter.
+    """
+    return await get_default().aget_tokens(code, lang=lang, filename=filename,
+                                           path=path)
+
+
+def aiter_tokens(lines, lang="", filename="", path=None):
+    """Asynchronous generator that yields tokens from code, or an iterable of
+    lines, highlighting it in chunks on the default AsyncHighlighter.
+    """
+    return get_default().aiter_tokens(lines, lang=lang, filename=filename,
+                                      path=path)
@@ -13,3 +13,16 @@ cdef object std_string_to_py(std_string x)
 
 cdef class _LangMap:
     cdef cpp_srchilite.LangMap * ptx
+
+
+cdef class Highlighter:
+    cdef cpp_srchilite.Highlighter * ptx
+    cdef readonly object path
+    cdef readonly object filename
+    cdef object _lock
+
+
+cdef class Renderer:
+    cdef cpp_srchilite.Renderer * ptx
+    cdef readonly object outlang
+    cdef readonly object style
@@ -4,15 +4,26 @@ from libcpp.map cimport map as std_map
 from libcpp.set cimport set as std_set
 from libcpp.string cimport string as std_string
 from libcpp.utility cimport pair as std_pair
+from libcpp.vector cimport vector as std_vector
 from libcpp cimport bool as cpp_bool
+from libc.stdint cimport uint32_t
+from libc.string cimport memcpy
+from cpython cimport array
 
 from cython.operator cimport dereference as deref
 
 from srchilite cimport cpp_srchilite
 from srchilite cimport bindings
 
+import io
 import os
-from collections import ChainMap
+import hashlib
+import re
+import array
+import mmap
+import threading
+import time
+from collections import ChainMap, OrderedDict, namedtuple
 from collections.abc import Mapping, Sequence, Hashable, MutableSequence
 
 
@@ -22,16 +33,34 @@ from collections.abc import Mapping, Sequence, Hashable, MutableSequence
 cdef std_string str_to_cpp(object x):
     cdef std_string s
     x = x.encode()
-    s = std_string(<const char*> x)
+    s = std_string(<const char*> x, len(x))
     return s
 
 
 cdef object std_string_to_py(std_string x):
-    pyx = x.c_str()
-    pyx = pyx.decode()
+    pyx = x.decode()
     return pyx
 
 
+cdef object as_byte_buffer(object x):
+    """Returns an object exporting the bytes of x through the buffer protocol,
+    encoding str and passing bytes-like objects through without copying.
+    """
+    if isinstance(x, str):
+        return x.encode()
+    elif isinstance(x, (bytes, bytearray)):
+        return x
+    return memoryview(x).cast("B")
+
+
+cdef std_string buffer_to_cpp(object x):
+    cdef const unsigned char[::1] buf = as_byte_buffer(x)
+    cdef std_string s
+    if buf.shape[0] > 0:
+        s = std_string(<const char*> &buf[0], buf.shape[0])
+    return s
+
+
 #
 # Binding classes & functions
 #
@@ -72,6 +101,8 @@ cdef class _LangMap:
     def __getitem__(self, key):
         cdef std_string cpp_key = str_to_cpp(key)
         cdef std_string cpp_value = self.ptx.getMappedFileName(cpp_key)
+        if cpp_value.empty():
+            raise KeyError(key)
         value = std_string_to_py(cpp_value)
         value = os.path.join(self.path, value)
         return value
@@ -111,19 +142,55 @@ def retrieve_data_dir(bint reload=False):
 #
 # API functions
 #
+cdef list _token_type_names():
+    cdef std_vector[std_string] cpp_names = cpp_srchilite.TOKEN_TYPE_NAMES
+    cdef std_string cpp_name
+    names = []
+    for cpp_name in cpp_names:
+        names.append(std_string_to_py(cpp_name))
+    return names
+
+
+# The ids of the token types that the native highlighter reports. These are
+# also their ids as _TokenType objects, so that there is a single space of
+# ids, shared with the type ids in a TokenArray.
+cdef dict _NATIVE_TOKEN_IDS = {name: i for i, name in
+                               enumerate(_token_type_names())}
+# All token types, indexed by their id. The native types' slots are filled in
+# as they are made, and other types get the ids after them.
+cdef list _TOKEN_TYPES_BY_ID = [None] * len(_NATIVE_TOKEN_IDS)
+
+
 class _TokenType(Sequence, Hashable):
     # Originally forked from Pygments
     # Copyright (c) 2006-2017 by the respective authors (see AUTHORS file).
     # All rights reserved.
-    parent = None
+    #
+    # Each token type has a dense integer id, and the set of the ids of
+    # itself and its ancestors, so that containment is a set look-up.
+    __slots__ = ("val", "_name", "parent", "subtypes", "_subtype_map", "id",
+                 "_ancestors", "_hash")
 
-    def __init__(self, val=()):
+    def __init__(self, val=(), parent=None):
+        # every slot is set here, before anything may read it, since reading
+        # an unset slot would fall through to __getattr__
         self.val = val
         self._name = "Token"
         if val:
             self._name += "." + ".".join(val)
+        self.parent = parent
         self.subtypes = set()
         self._subtype_map = {}
+        self.id = _NATIVE_TOKEN_IDS.get(".".join(val), len(_TOKEN_TYPES_BY_ID))
+        if parent is None:
+            self._ancestors = frozenset([self.id])
+        else:
+            self._ancestors = parent._ancestors | {self.id}
+        self._hash = hash(val)
+        if self.id < len(_TOKEN_TYPES_BY_ID):
+            _TOKEN_TYPES_BY_ID[self.id] = self
+        else:
+            _TOKEN_TYPES_BY_ID.append(self)
 
     def __getitem__(self, key):
         return self.val[key]
@@ -131,24 +198,29 @@ class _TokenType(Sequence, Hashable):
     def __len__(self):
         return len(self.val)
 
+    def __iter__(self):
+        return iter(self.val)
+
     def __contains__(self, item):
         return self is item or (
-            type(item) is self.__class__ and
-            item[:len(self)] == self
+            type(item) is _TokenType and self.id in item._ancestors
         )
 
     def __getattr__(self, name):
+        # as in Pygments, only capitalized names make subtypes, so that
+        # special names, such as __dict__ or _repr_html_, are still missing
+        if not name or not name[0].isupper():
+            return object.__getattribute__(self, name)
         spec = self.val + (name,)
         if spec in self._subtype_map:
             return self._subtype_map[spec]
-        new = _TokenType(spec)
-        new.parent = self
+        new = _TokenType(spec, parent=self)
         self.subtypes.add(new)
         self._subtype_map[spec] = new
         return new
 
     def __repr__(self):
-        return 'Token' + (self and '.' or '') + '.'.join(self)
+        return self._name
 
     def __copy__(self):
         # These instances are supposed to be singletons
@@ -158,8 +230,12 @@ class _TokenType(Sequence, Hashable):
         # These instances are supposed to be singletons
         return self
 
+    def __reduce__(self):
+        # pickle by name, so that unpickling gives back the singleton
+        return string_to_token, (".".join(self.val),)
+
     def __hash__(self):
-        return hash(self.val)
+        return self._hash
 
     def split(self):
         buf = []
@@ -199,46 +275,1112 @@ def string_to_token(str s):
 string_to_tokentype = string_to_token
 
 
-def get_tokens(str code, str lang="", str filename="", object path=None):
-    """Returns token list from code in a give language
+def token_from_id(int i):
+    """Returns the token type whose id is i. The type ids in a TokenArray are
+    token type ids, so this also gives the type of a TokenArray entry.
     """
-    cdef std_string cpp_code = str_to_cpp(code)
-    cdef std_string cpp_filename
-    cdef std_string cpp_path
-    cdef cpp_srchilite.TokenPairsPtr cpp_tokens
-    cdef cpp_srchilite.TokenPair cpp_token
+    if i < 0:
+        raise IndexError("token type id out of range")
+    return _TOKEN_TYPES_BY_ID[i]
+
+
+#
+# instrumentation
+#
+cdef bint _STATS_ENABLED = False
+_STATS_LOCK = threading.Lock()
+_STATS_CALLBACK = None
+_STATS = None
+
+
+def _new_stats():
+    return {"phases": {}, "langs": {}, "caches": {}}
+
+
+def enable_stats(callback=None):
+    """Starts collecting highlighting statistics. If given, callback is
+    called as callback(phase, filename, seconds) after every timed phase,
+    where filename is the lang file, or None for the lang map lookup.
+    """
+    global _STATS_ENABLED, _STATS_CALLBACK, _STATS
+    with _STATS_LOCK:
+        if _STATS is None:
+            _STATS = _new_stats()
+        _STATS_CALLBACK = callback
+        _STATS_ENABLED = True
+
+
+def disable_stats():
+    """Stops collecting highlighting statistics, keeping those collected"""
+    global _STATS_ENABLED, _STATS_CALLBACK
+    _STATS_ENABLED = False
+    _STATS_CALLBACK = None
+
+
+def reset_stats():
+    """Discards all collected statistics"""
+    global _STATS
+    with _STATS_LOCK:
+        _STATS = _new_stats() if _STATS_ENABLED else None
+
+
+def stats():
+    """Returns a snapshot of the statistics collected since enable_stats().
+    This is a dict with:
+
+    * "phases": {phase: {"calls": int, "seconds": float}}, for the
+      "lang_map", "load", "highlight", "convert", and "render" phases,
+    * "langs": {lang file: {"calls": int, "bytes": int, "tokens": int}},
+    * "caches": {cache: {"hits": int, "misses": int}}, for the
+      highlighter "pool" and token "memo" caches.
+    """
+    with _STATS_LOCK:
+        if _STATS is None:
+            return _new_stats()
+        return {key: {k: dict(v) for k, v in value.items()}
+                for key, value in _STATS.items()}
+
+
+cdef _record_phase(str phase, object filename, double seconds):
+    with _STATS_LOCK:
+        if _STATS is None:
+            return
+        phases = _STATS["phases"]
+        if phase not in phases:
+            phases[phase] = {"calls": 0, "seconds": 0.0}
+        entry = phases[phase]
+        entry["calls"] += 1
+        entry["seconds"] += seconds
+    callback = _STATS_CALLBACK
+    if callback is not None:
+        callback(phase, filename, seconds)
+
+
+cdef _record_highlight(str filename, double highlight_seconds,
+                       double convert_seconds, size_t nbytes, size_t ntokens):
+    _record_phase("highlight", filename, highlight_seconds)
+    _record_phase("convert", filename, convert_seconds)
+    _record_lang(filename, nbytes, ntokens)
+
+
+cdef _record_lang(str filename, size_t nbytes, size_t ntokens):
+    with _STATS_LOCK:
+        if _STATS is None:
+            return
+        langs = _STATS["langs"]
+        if filename not in langs:
+            langs[filename] = {"calls": 0, "bytes": 0, "tokens": 0}
+        entry = langs[filename]
+        entry["calls"] += 1
+        entry["bytes"] += nbytes
+        entry["tokens"] += ntokens
+
+
+cdef _record_cache(str cache, bint hit):
+    # callers check _STATS_ENABLED first, so that cache hits stay cheap
+    with _STATS_LOCK:
+        if _STATS is None:
+            return
+        caches = _STATS["caches"]
+        if cache not in caches:
+            caches[cache] = {"hits": 0, "misses": 0}
+        caches[cache]["hits" if hit else "misses"] += 1
+
+
+def _resolve_lang_file(str lang="", str filename="", object path=None):
+    """Returns the (path, filename) pair of the lang file to use."""
+    cdef double t0
     if lang:
-        path, filename = os.path.split(LANG_MAP_CACHE[lang])
+        if _STATS_ENABLED:
+            t0 = time.perf_counter()
+            path, filename = os.path.split(LANG_MAP_CACHE[lang])
+            _record_phase("lang_map", None, time.perf_counter() - t0)
+        else:
+            path, filename = os.path.split(LANG_MAP_CACHE[lang])
     elif not filename:
         raise ValueError("Either 'lang' or 'filename' must be given "
                          "and non-empty")
     elif path is None:
         path, filename = os.path.split(filename)
-    cpp_filename = str_to_cpp(filename)
-    cpp_path = str_to_cpp(path)
-    cpp_tokens = cpp_srchilite.get_tokens(cpp_code, cpp_path, cpp_filename)
+    return path, filename
+
+
+cdef list token_pairs_to_py(cpp_srchilite.TokenPairs& cpp_tokens):
+    cdef cpp_srchilite.TokenPair cpp_token
     tokens = []
-    for cpp_token in deref(cpp_tokens):
+    for cpp_token in cpp_tokens:
         first = std_string_to_py(cpp_token.first)
         token = string_to_token(first)
-        second = std_string_to_py(cpp_token.second)
+        # tokens from bytes input need not be valid UTF-8
+        second = cpp_token.second.decode("utf-8", "surrogateescape")
         tokens.append((token, second))
     return tokens
+
+
+cdef array.array UINT32_ARRAY_TEMPLATE = array.array("I")
+
+
+cdef array.array uint32_vector_to_array(std_vector[uint32_t]& v):
+    cdef array.array arr = array.clone(UINT32_ARRAY_TEMPLATE, v.size(), False)
+    if v.size() > 0:
+        memcpy(arr.data.as_voidptr, v.data(), v.size() * sizeof(uint32_t))
+    return arr
+
+
+# The token types that the native highlighter reports, which are also the
+# types that the type ids in a TokenArray refer to. TOKEN_TYPES[i].id == i.
+TOKEN_TYPES = tuple(map(string_to_token, _token_type_names()))
+
+
+class TokenArray(Sequence):
+    """A compact, columnar token list. Rather than a tuple per token, token
+    types are stored as their integer ids, which index TOKEN_TYPES, and token
+    values as [start, end) offsets into the text, all in array('I') columns.
+    Indexing gives (Token, str) pairs, which are created on demand.
+    """
+    __slots__ = ("text", "types", "starts", "ends")
+
+    def __init__(self, text, types, starts, ends):
+        self.text = text
+        self.types = types
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        return (TOKEN_TYPES[self.types[key]],
+                self.text[self.starts[key]:self.ends[key]])
+
+    def __repr__(self):
+        return "<TokenArray of {0} tokens>".format(len(self))
+
+    def token_type(self, i):
+        """Returns the type of the i-th token"""
+        return TOKEN_TYPES[self.types[i]]
+
+    def value(self, i):
+        """Returns the value of the i-th token"""
+        return self.text[self.starts[i]:self.ends[i]]
+
+
+cdef object token_columns_to_py(str code, cpp_srchilite.TokenColumns& columns):
+    if code and not code.endswith("\n"):
+        # the highlighter ends every line with a newline token
+        code += "\n"
+    return TokenArray(code, uint32_vector_to_array(columns.types),
+                      uint32_vector_to_array(columns.starts),
+                      uint32_vector_to_array(columns.ends))
+
+
+# Profile of a single rule of a highlight state, see
+# Highlighter.enable_profiling()
+RuleProfile = namedtuple("RuleProfile", ["state", "index", "rule", "elems",
+                                         "attempts", "successes", "seconds"])
+
+
+cdef class Highlighter:
+    """A highlighter that keeps its language definition compiled, so that
+    it may tokenize many pieces of code without reloading the lang file.
+
+    Parameters
+    ----------
+    lang : str, optional
+        The language name, as found in LANG_MAP_CACHE.
+    filename : str, optional
+        The lang file to use, if lang is not given.
+    path : str, optional
+        The directory to search for the filename in.
+    """
+
+    def __cinit__(self, str lang="", str filename="", object path=None):
+        cdef std_string cpp_path
+        cdef std_string cpp_filename
+        cdef cpp_srchilite.Highlighter * ptx
+        cdef bint timed
+        cdef double t0
+        path, filename = _resolve_lang_file(lang, filename, path)
+        self.path = path
+        self.filename = filename
+        self._lock = threading.Lock()
+        cpp_path = str_to_cpp(path)
+        cpp_filename = str_to_cpp(filename)
+        timed = _STATS_ENABLED
+        if timed:
+            t0 = time.perf_counter()
+        # lang files may be loaded by other threads while this one waits
+        with nogil:
+            ptx = new cpp_srchilite.Highlighter(cpp_path, cpp_filename)
+        self.ptx = ptx
+        if timed:
+            _record_phase("load", self.filename, time.perf_counter() - t0)
+
+    def __dealloc__(self):
+        del self.ptx
+
+    def __repr__(self):
+        return "Highlighter(filename={0!r}, path={1!r})".format(self.filename,
+                                                               self.path)
+
+    def get_tokens(self, object code):
+        """Returns token list from code, which may be a str or any bytes-like
+        object, such as bytes, bytearray, memoryview, or mmap. Bytes-like
+        objects are highlighted in place, without being copied.
+        """
+        cdef const unsigned char[::1] buf = as_byte_buffer(code)
+        cdef const char * data = NULL
+        cdef size_t size = buf.shape[0]
+        cdef cpp_srchilite.TokenPairsPtr cpp_tokens
+        cdef bint timed = _STATS_ENABLED
+        cdef double t0, t1
+        if size > 0:
+            data = <const char*> &buf[0]
+        if timed:
+            t0 = time.perf_counter()
+        with self._lock:
+            with nogil:
+                cpp_tokens = self.ptx.get_tokens(data, size)
+        if not timed:
+            return token_pairs_to_py(deref(cpp_tokens))
+        t1 = time.perf_counter()
+        tokens = token_pairs_to_py(deref(cpp_tokens))
+        _record_highlight(self.filename, t1 - t0, time.perf_counter() - t1,
+                          size, len(tokens))
+        return tokens
+
+    def get_tokens_many(self, codes):
+        """Returns a token list for each code in an iterable of codes. All of
+        the codes are highlighted in a single native call.
+        """
+        cdef std_vector[std_string] cpp_codes
+        cdef cpp_srchilite.TokenPairsPtrs cpp_tokens_many
+        cdef cpp_srchilite.TokenPairsPtr cpp_tokens
+        cdef bint timed = _STATS_ENABLED
+        cdef double t0, t1
+        cdef size_t i, nbytes = 0, ntokens = 0
+        for code in codes:
+            cpp_codes.push_back(buffer_to_cpp(code))
+        if timed:
+            t0 = time.perf_counter()
+        with self._lock:
+            with nogil:
+                cpp_tokens_many = self.ptx.get_tokens_many(cpp_codes)
+        if timed:
+            t1 = time.perf_counter()
+        rtn = []
+        for cpp_tokens in cpp_tokens_many:
+            rtn.append(token_pairs_to_py(deref(cpp_tokens)))
+        if timed:
+            for i in range(cpp_codes.size()):
+                nbytes += cpp_codes[i].size()
+                ntokens += len(rtn[i])
+            _record_highlight(self.filename, t1 - t0, time.perf_counter() - t1,
+                              nbytes, ntokens)
+        return rtn
+
+    def get_token_array(self, str code):
+        """Returns a compact TokenArray from code"""
+        cdef std_string cpp_code = str_to_cpp(code)
+        cdef cpp_srchilite.TokenColumnsPtr cpp_columns
+        cdef bint timed = _STATS_ENABLED
+        cdef double t0, t1
+        if timed:
+            t0 = time.perf_counter()
+        with self._lock:
+            with nogil:
+                cpp_columns = self.ptx.get_token_columns(cpp_code)
+        if not timed:
+            return token_columns_to_py(code, deref(cpp_columns))
+        t1 = time.perf_counter()
+        tokens = token_columns_to_py(code, deref(cpp_columns))
+        _record_highlight(self.filename, t1 - t0, time.perf_counter() - t1,
+                          cpp_code.size(), len(tokens))
+        return tokens
+
+    def enable_profiling(self):
+        """Counts and times the match attempts of every rule in the language
+        definition from now on. Profiling slows down highlighting, so this
+        is best used on a highlighter of its own, rather than a pooled one.
+        """
+        with self._lock:
+            self.ptx.enable_profiling()
+
+    def rule_profile(self):
+        """Returns a RuleProfile for every rule, if profiling is enabled,
+        ranked by the cumulative time spent matching it.
+        """
+        cdef std_vector[cpp_srchilite.RuleStats] cpp_stats
+        cdef cpp_srchilite.RuleStats cpp_stat
+        with self._lock:
+            cpp_stats = self.ptx.rule_stats()
+        rtn = []
+        for cpp_stat in cpp_stats:
+            rtn.append(RuleProfile(cpp_stat.state_id, cpp_stat.index,
+                                   std_string_to_py(cpp_stat.rule),
+                                   std_string_to_py(cpp_stat.elems),
+                                   cpp_stat.attempts, cpp_stat.successes,
+                                   cpp_stat.seconds))
+        rtn.sort(key=lambda p: p.seconds, reverse=True)
+        return rtn
+
+    def iter_tokens(self, lines):
+        """Generator that yields tokens from an iterable of lines, such as a
+        file-like object. Lines are highlighted one at a time, so memory use
+        is bounded by the longest line rather than by the whole input.
+        """
+        stream = _LineStream(self)
+        if isinstance(lines, str):
+            lines = io.StringIO(lines)
+        for line in _iter_lines(lines):
+            yield from stream.highlight_line(line)
+
+
+def _iter_lines(lines):
+    for line in lines:
+        if line.endswith("\n"):
+            line = line[:-1]
+        if "\n" in line:
+            yield from line.split("\n")
+        else:
+            yield line
+
+
+cdef class _LineStream:
+    """Highlights lines one after another, carrying the highlighter state
+    over from each line to the next. The state is kept here, rather than on
+    the highlighter, so that the highlighter may be used by others in between
+    lines.
+    """
+    cdef Highlighter highlighter
+    cdef cpp_srchilite.LineState state
+
+    def __cinit__(self, Highlighter highlighter):
+        self.highlighter = highlighter
+
+    def highlight_line(self, str line):
+        """Returns the token list for a line, without its newline"""
+        cdef std_string cpp_line = str_to_cpp(line)
+        cdef cpp_srchilite.TokenPairsPtr cpp_tokens
+        cdef cpp_srchilite.Highlighter * ptx = self.highlighter.ptx
+        cdef bint timed = _STATS_ENABLED
+        cdef double t0, t1
+        if timed:
+            t0 = time.perf_counter()
+        with self.highlighter._lock:
+            with nogil:
+                cpp_tokens = ptx.highlight_line(cpp_line, self.state)
+        if not timed:
+            return token_pairs_to_py(deref(cpp_tokens))
+        t1 = time.perf_counter()
+        tokens = token_pairs_to_py(deref(cpp_tokens))
+        _record_highlight(self.highlighter.filename, t1 - t0,
+                          time.perf_counter() - t1, cpp_line.size() + 1,
+                          len(tokens))
+        return tokens
+
+
+def _split_lines(str code):
+    """Splits code into lines, the same way that the highlighter does."""
+    lines = code.split("\n")
+    if lines[-1] == "":
+        del lines[-1]
+    return lines
+
+
+TokenDelta = namedtuple("TokenDelta", ["start", "stop", "lines"])
+TokenDelta.__doc__ = """The change in a document's tokens from an edit. The
+per-line token lists in lines replace the previous lines[start:stop].
+"""
+
+
+cdef class Document:
+    """A document that is kept highlighted as it is edited. The highlighter
+    state at each line boundary is remembered, so an edit only re-highlights
+    from the first changed line up to the first line whose starting state is
+    the same as it was before the edit.
+
+    Parameters
+    ----------
+    code : str, optional
+        The initial text of the document.
+    lang : str, optional
+        The language name, as found in LANG_MAP_CACHE.
+    filename : str, optional
+        The lang file to use, if lang is not given.
+    path : str, optional
+        The directory to search for the filename in.
+    """
+    cdef Highlighter highlighter
+    cdef cpp_srchilite.Document doc
+    cdef list _lines
+
+    def __cinit__(self, str code="", str lang="", str filename="",
+                  object path=None):
+        self.highlighter = get_highlighter(lang=lang, filename=filename,
+                                           path=path)
+        self._lines = []
+        if code:
+            self.replace_lines(0, 0, _split_lines(code))
+
+    def __len__(self):
+        return len(self._lines)
+
+    @property
+    def lines(self):
+        """The lines of the document, without newlines"""
+        return list(self._lines)
+
+    @property
+    def tokens(self):
+        """The token list of the whole document"""
+        tokens = []
+        for i in range(len(self._lines)):
+            tokens.extend(self.line_tokens(i))
+        return tokens
+
+    def line_tokens(self, size_t i):
+        """Returns the token list for the i-th line"""
+        if i >= self.doc.line_tokens.size():
+            raise IndexError("line index out of range")
+        return token_pairs_to_py(deref(self.doc.line_tokens[i]))
+
+    def replace_lines(self, start, stop, new_lines):
+        """Replaces the lines in [start, stop) with new lines (which should
+        not contain newlines) and returns the resulting TokenDelta.
+        """
+        cdef size_t cpp_start, cpp_stop, end
+        cdef std_vector[std_string] cpp_lines
+        cdef cpp_srchilite.Highlighter * ptx = self.highlighter.ptx
+        cdef bint timed = _STATS_ENABLED
+        cdef double t0, t1
+        new_lines = list(new_lines)
+        start, stop, _ = slice(start, stop).indices(len(self._lines))
+        stop = max(start, stop)
+        for line in new_lines:
+            cpp_lines.push_back(str_to_cpp(line))
+        cpp_start = start
+        cpp_stop = stop
+        if timed:
+            t0 = time.perf_counter()
+        with self.highlighter._lock:
+            with nogil:
+                end = self.doc.replace_lines(deref(ptx), cpp_start, cpp_stop,
+                                             cpp_lines)
+        if timed:
+            t1 = time.perf_counter()
+        self._lines[start:stop] = new_lines
+        old_stop = end - len(new_lines) + (stop - start)
+        lines = [self.line_tokens(i) for i in range(start, end)]
+        if timed:
+            # only the lines in [start, end) were highlighted again
+            _record_highlight(self.highlighter.filename, t1 - t0,
+                              time.perf_counter() - t1,
+                              sum(len(self._lines[i]) + 1
+                                  for i in range(start, end)),
+                              sum(len(tokens) for tokens in lines))
+        return TokenDelta(start, old_stop, lines)
+
+    def update(self, str code):
+        """Sets the text of the document, re-highlighting only what the
+        change requires, and returns the resulting TokenDelta.
+        """
+        old = self._lines
+        new = _split_lines(code)
+        n = min(len(old), len(new))
+        # skip the lines common to the beginning and end
+        start = 0
+        while start < n and old[start] == new[start]:
+            start += 1
+        end = 0
+        while end < n - start and old[-1 - end] == new[-1 - end]:
+            end += 1
+        return self.replace_lines(start, len(old) - end,
+                                  new[start:len(new) - end])
+
+
+class _HighlighterPool:
+    """Pool of highlighters, keyed by the (path, filename) of their lang file.
+    Each thread gets its own least-recently-used set of highlighters, so that
+    threads highlighting the same language never share a SourceHighlighter.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._generation = 0
+
+    def _cache(self):
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            local.cache = OrderedDict()
+            local.generation = self._generation
+        return local.cache
+
+    def __len__(self):
+        return len(self._cache())
+
+    def __contains__(self, key):
+        return key in self._cache()
+
+    def get(self, path, filename):
+        """Returns the current thread's highlighter for the lang file,
+        creating it if needed.
+        """
+        key = (path, filename)
+        cache = self._cache()
+        if key in cache:
+            cache.move_to_end(key)
+            if _STATS_ENABLED:
+                _record_cache("pool", True)
+            return cache[key]
+        if _STATS_ENABLED:
+            _record_cache("pool", False)
+        highlighter = Highlighter(filename=filename, path=path)
+        cache[key] = highlighter
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return highlighter
+
+    def clear(self):
+        """Removes all highlighters from the pool, in every thread"""
+        self._generation += 1
+
+
+HIGHLIGHTER_POOL = _HighlighterPool()
+
+
+def get_highlighter(str lang="", str filename="", object path=None):
+    """Returns the current thread's pooled highlighter for the given
+    language.
+    """
+    path, filename = _resolve_lang_file(lang, filename, path)
+    return HIGHLIGHTER_POOL.get(path, filename)
+
+
+def preload(*langs):
+    """Loads highlighters for the given languages ahead of time, into the
+    calling thread's pool only, since highlighters are never shared between
+    threads. Calling this in a parent process before forking workers lets
+    them all start with the languages already compiled, while other threads
+    still load their own on first use.
+    """
+    for lang in langs:
+        get_highlighter(lang=lang)
+
+
+class _TokenMemo:
+    """Memo of token lists, keyed by a digest of the code and the path of
+    the lang file it was highlighted with. Like the highlighter pool, the
+    memo does not notice edits to lang files. The memo is bounded by the
+    total size of the token values it holds, plus a fixed overhead per token,
+    and evicts the least recently used entries first. Token lists are stored
+    and returned as tuples, so that they may be shared.
+    """
+
+    token_overhead = 16
+
+    def __init__(self, maxbytes=64 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, object code, path, filename):
+        digest = hashlib.blake2b(as_byte_buffer(code), digest_size=16).digest()
+        return (digest, type(code) is str, path, filename)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+        return None
+
+    def put(self, key, tokens):
+        tokens = tuple(tokens)
+        nbytes = self.token_overhead * len(tokens)
+        for _, value in tokens:
+            nbytes += len(value)
+        if nbytes > self.maxbytes:
+            return tokens
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._entries[key] = (tokens, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.maxbytes:
+                _, (_, n) = self._entries.popitem(last=False)
+                self.nbytes -= n
+        return tokens
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# The _TokenMemo that get_tokens() looks results up in, if any.
+TOKEN_MEMO = None
+
+
+def enable_memo(maxbytes=64 * 1024 * 1024):
+    """Memoizes the results of get_tokens(), holding up to roughly maxbytes
+    of tokens. While enabled, get_tokens() returns tuples of tokens. Lang
+    files are not checked for edits, so call this again to start afresh
+    after changing one, along with HIGHLIGHTER_POOL.clear().
+    """
+    global TOKEN_MEMO
+    TOKEN_MEMO = _TokenMemo(maxbytes=maxbytes)
+    return TOKEN_MEMO
+
+
+def disable_memo():
+    """Stops memoizing the results of get_tokens()"""
+    global TOKEN_MEMO
+    TOKEN_MEMO = None
+
+
+def get_tokens(object code, str lang="", str filename="", object path=None):
+    """Returns token list from code in a give language. The code may be a
+    str or any bytes-like object. If the memo is enabled with enable_memo(),
+    the tokens are a tuple, which may be shared with other callers.
+    """
+    memo = TOKEN_MEMO
+    if memo is None:
+        highlighter = get_highlighter(lang=lang, filename=filename, path=path)
+        return highlighter.get_tokens(code)
+    path, filename = _resolve_lang_file(lang, filename, path)
+    key = memo.key(code, path, filename)
+    tokens = memo.get(key)
+    if _STATS_ENABLED:
+        _record_cache("memo", tokens is not None)
+    if tokens is None:
+        highlighter = HIGHLIGHTER_POOL.get(path, filename)
+        tokens = memo.put(key, highlighter.get_tokens(code))
+    return tokens
+
+
+def get_tokens_many(codes, str lang="", str filename="", object path=None):
+    """Returns a token list for each code in an iterable of codes, all in the
+    same language.
+    """
+    highlighter = get_highlighter(lang=lang, filename=filename, path=path)
+    return highlighter.get_tokens_many(codes)
+
+
+def _lang_key(key):
+    """Returns the key, or its lower-case form, if it is a known language"""
+    if not key:
+        return None
+    elif key in LANG_MAP_CACHE:
+        return key
+    key = key.lower()
+    return key if key in LANG_MAP_CACHE else None
+
+
+def _lang_from_filename(filename):
+    base = os.path.basename(filename)
+    lang = _lang_key(base)
+    if lang is not None:
+        return lang
+    # try compound extensions before simple ones, "pkg.in" before "in"
+    parts = base.split(".")
+    for i in range(1, len(parts)):
+        lang = _lang_key(".".join(parts[i:]))
+        if lang is not None:
+            return lang
+    return None
+
+
+# Regexes here are left as strings, rather than compiled at import time, and
+# are compiled once, by _compile(), when they are first used.
+cdef dict _COMPILED_RES = {}
+
+
+cdef object _compile(str regex):
+    rx = _COMPILED_RES.get(regex, None)
+    if rx is None:
+        rx = _COMPILED_RES[regex] = re.compile(regex)
+    return rx
+
+
+SHEBANG_RE = r"^#!\s*(\S+)(?:\s+(\S+))?"
+EMACS_MODE_RE = r"(?i)-\*-\s*(?:.*?\bmode:\s*)?([\w+#-]+)\s*;?.*?-\*-"
+VIM_MODE_RE = r"\bvim?:.*?\b(?:ft|filetype|syntax)=([\w+#-]+)"
+
+
+def _interpreter_names(interp):
+    """Returns the names to look an interpreter up by, from the most to the
+    least specific, e.g. "python3.7" -> ["python3.7", "python3", "python"].
+    """
+    names = [interp]
+    for name in (_compile(r"(\.\d+)+$").sub("", interp),
+                 interp.rstrip("0123456789.-")):
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def _lang_from_shebang(line):
+    m = _compile(SHEBANG_RE).match(line)
+    if m is None:
+        return None
+    interp = os.path.basename(m.group(1))
+    if interp == "env" and m.group(2):
+        interp = os.path.basename(m.group(2))
+    for name in _interpreter_names(interp):
+        lang = _lang_key(name)
+        if lang is not None:
+            return lang
+    return None
+
+
+def _lang_from_modeline(line):
+    for regex in (EMACS_MODE_RE, VIM_MODE_RE):
+        m = _compile(regex).search(line)
+        if m is not None:
+            lang = _lang_key(m.group(1))
+            if lang is not None:
+                return lang
+    return None
+
+
+# Cheap content checks, tried in order. Each is a regex that is searched for
+# in the beginning of the code, and the language it means.
+CONTENT_SNIFFERS = [
+    (r"\A<\?xml\b", "xml"),
+    (r"(?i)\A\s*<!DOCTYPE\s+html|\A\s*<html\b", "html"),
+    (r"\A<\?php\b", "php"),
+    (r"(?m)^diff (?:--git )?\S|^--- \S.*\n\+\+\+ \S|^@@ -\d+(?:,\d+)? \+\d+", "diff"),
+    (r"(?m)^#\s*(?:include\s*[<\"]|define\s+\w|ifndef\s+\w)", "c"),
+    (r"(?m)\A(?:\s*(?:[;#].*)?\n)*\s*\[[\w. -]+\]\s*\n\s*[\w.-]+\s*[=:]", "ini"),
+    (r"(?m)^Name:.*\n(?:.*\n)*?(?:Libs|Cflags|Requires):", "pkgconfig"),
+]
+SNIFF_SIZE = 4096
+
+
+def _lang_from_content(code):
+    head = code[:SNIFF_SIZE]
+    for regex, lang in CONTENT_SNIFFERS:
+        if _compile(regex).search(head) is not None:
+            lang = _lang_key(lang)
+            if lang is not None:
+                return lang
+    return None
+
+
+def guess_lang(filename=None, first_line=None, code=None):
+    """Guesses the language of some code, without highlighting anything.
+    This tries, in order, the filename (its full name, then its extensions)
+    against LANG_MAP_CACHE, a shebang or an Emacs or Vim modeline, and
+    finally some cheap checks on the code's contents. Returns the language
+    name, as found in LANG_MAP_CACHE, or None if it could not be guessed.
+
+    Parameters
+    ----------
+    filename : str, optional
+        The name of the file the code is from.
+    first_line : str, optional
+        The first line of the code, if the code itself is not given.
+    code : str, optional
+        The code, or its beginning.
+    """
+    if filename:
+        lang = _lang_from_filename(filename)
+        if lang is not None:
+            return lang
+    lines = []
+    if first_line is not None:
+        lines.append(first_line)
+    if code:
+        head = code[:SNIFF_SIZE].splitlines()
+        tail = code[-SNIFF_SIZE:].splitlines()
+        lines.extend(head[:5])
+        # modelines may also be at the end of the file
+        lines.extend(tail[-5:])
+    if lines:
+        lang = _lang_from_shebang(lines[0])
+        if lang is not None:
+            return lang
+        for line in lines:
+            lang = _lang_from_modeline(line)
+            if lang is not None:
+                return lang
+    if code:
+        return _lang_from_content(code)
+    return None
+
+
+def _guess_file_lang(path):
+    """Guesses the language of a file from its name, only reading the start
+    of the file if needed.
+    """
+    lang = _lang_from_filename(path)
+    if lang is not None:
+        return lang
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_SIZE).decode("utf-8", "replace")
+    lang = guess_lang(code=head)
+    if lang is None:
+        raise ValueError("could not determine the language of {0!r}".format(path))
+    return lang
+
+
+def highlight_file(path, object lang=None):
+    """Returns the token list of a file, which is memory-mapped and
+    highlighted in place rather than read into a str. If lang is not given,
+    it is guessed from the file's name and contents.
+    """
+    if not lang:
+        lang = _guess_file_lang(path)
+    highlighter = get_highlighter(lang=lang)
+    with open(path, "rb") as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            return highlighter.get_tokens(b"")
+        with m:
+            return highlighter.get_tokens(m)
+
+
+def get_token_array(str code, str lang="", str filename="",
+                    object path=None):
+    """Returns a compact TokenArray from code in a given language."""
+    highlighter = get_highlighter(lang=lang, filename=filename, path=path)
+    return highlighter.get_token_array(code)
+
+
+def iter_tokens(lines, str lang="", str filename="", object path=None):
+    """Generator that yields tokens from an iterable of lines, such as a
+    file-like object, in a given language. This keeps memory bounded for
+    arbitrarily large inputs.
+    """
+    highlighter = get_highlighter(lang=lang, filename=filename, path=path)
+    yield from highlighter.iter_tokens(lines)
+
+
+def _data_dirs():
+    for p in PY_SOURCE_HIGHLIGHT_PATH:
+        p = os.path.abspath(p)
+        yield p if os.path.isdir(p) else os.path.dirname(p)
+
+
+def _find_data_file(name):
+    """Finds a file, either as given or in the PY_SOURCE_HIGHLIGHT_PATH"""
+    if os.path.isfile(name):
+        return os.path.abspath(name)
+    for d in _data_dirs():
+        f = os.path.join(d, name)
+        if os.path.isfile(f):
+            return f
+    raise ValueError("could not find {0!r} in PY_SOURCE_HIGHLIGHT_PATH".format(name))
+
+
+def _find_outlang_file(outlang):
+    """Finds an outlang file from its name in an outlang.map, or its filename"""
+    if not os.path.isfile(outlang) and not outlang.endswith(".outlang"):
+        for d in _data_dirs():
+            if not os.path.isfile(os.path.join(d, "outlang.map")):
+                continue
+            outlang_map = LangMap(filename="outlang.map", path=d)
+            if outlang in outlang_map:
+                return outlang_map[outlang]
+        outlang += ".outlang"
+    return _find_data_file(outlang)
+
+
+def _find_style_file(style):
+    """Finds a style file from its name or its filename"""
+    if not os.path.isfile(style) and not os.path.splitext(style)[1]:
+        style += ".style"
+    return _find_data_file(style)
+
+
+cdef class Renderer:
+    """Renders code straight to a formatted string, such as one with ANSI
+    escape codes, using source-highlight's own formatters. No Python token
+    objects are made along the way.
+
+    Parameters
+    ----------
+    outlang : str, optional
+        The output language, either a name in an outlang.map or a filename.
+    style : str, optional
+        The style, either a name or a filename.
+    """
+
+    def __cinit__(self, str outlang="monokai_esc256", str style="monokai"):
+        cdef std_string cpp_data_dir
+        cdef std_string cpp_outlang
+        cdef std_string cpp_style
+        cdef cpp_srchilite.Renderer * ptx
+        self.outlang = _find_outlang_file(outlang)
+        self.style = _find_style_file(style)
+        data_dir, outlang_file = os.path.split(self.outlang)
+        cpp_data_dir = str_to_cpp(data_dir)
+        cpp_outlang = str_to_cpp(outlang_file)
+        cpp_style = str_to_cpp(self.style)
+        # the constructor waits on the lang definition lock, which another
+        # thread may hold for a whole render
+        with nogil:
+            ptx = new cpp_srchilite.Renderer(cpp_data_dir, cpp_outlang,
+                                             cpp_style)
+        self.ptx = ptx
+
+    def __dealloc__(self):
+        del self.ptx
+
+    def __repr__(self):
+        return "Renderer(outlang={0!r}, style={1!r})".format(self.outlang,
+                                                            self.style)
+
+    def highlight(self, object code, str lang="", str filename="",
+                  object path=None):
+        """Returns code in a given language rendered as a string"""
+        cdef std_string cpp_code = buffer_to_cpp(code)
+        cdef std_string cpp_lang_file
+        cdef std_string cpp_rtn
+        cdef bint timed = _STATS_ENABLED
+        cdef double t0
+        path, filename = _resolve_lang_file(lang, filename, path)
+        cpp_lang_file = str_to_cpp(os.path.abspath(os.path.join(path, filename)))
+        if timed:
+            t0 = time.perf_counter()
+        with nogil:
+            cpp_rtn = self.ptx.highlight(cpp_code, cpp_lang_file)
+        if timed:
+            # rendering makes no tokens, so only bytes are counted
+            _record_phase("render", filename, time.perf_counter() - t0)
+            _record_lang(filename, cpp_code.size(), 0)
+        return cpp_rtn.decode("utf-8", "surrogateescape")
+
+
+# renderers are not shared between threads, since a SourceHighlight
+# instance is not safe to use from more than one thread at a time
+_RENDERERS = threading.local()
+
+
+def get_renderer(str outlang="monokai_esc256", str style="monokai"):
+    """Returns the current thread's cached renderer for the given outlang and
+    style.
+    """
+    key = (outlang, style)
+    renderers = getattr(_RENDERERS, "cache", None)
+    if renderers is None:
+        renderers = _RENDERERS.cache = {}
+    renderer = renderers.get(key, None)
+    if renderer is None:
+        renderer = renderers[key] = Renderer(outlang=outlang, style=style)
+    return renderer
+
+
+def highlight(object code, str lang="", str outlang="monokai_esc256",
+              str style="monokai", str filename="", object path=None):
+    """Returns code in a given language rendered as a string by
+    source-highlight, with the given outlang and style. By default, this is
+    colored for 256-color terminals.
+    """
+    renderer = get_renderer(outlang=outlang, style=style)
+    return renderer.highlight(code, lang=lang, filename=filename, path=path)
+
+
 #
 # Custom API
 #
 
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
 class _LangMapCache(ChainMap):
     """Unified look-up for muliple. The initial empty dictionary is
     a trap that catches user settings. The lang_map items here are kept
     in-sync below by PY_SOURCE_HIGHLIGHT_PATH
+
+    Look-ups go through a flat index from language names to lang file paths.
+    The index is rebuilt only when the maps change, either because
+    PY_SOURCE_HIGHLIGHT_PATH did or because a map file was modified. Map
+    files are checked for modifications at most every check_interval seconds.
+    The maps are only loaded when they are first needed.
     """
 
+    check_interval = 1.0
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._trap = {}
         self.maps = [self._trap]
-        self.reset_maps()
+        self._index = None
+        self._mtimes = {}
+        self._next_check = 0.0
+        self._maps_stale = True
+
+    def _get_index(self):
+        index = self._index
+        if index is not None:
+            now = time.monotonic()
+            if now < self._next_check:
+                return index
+            self._next_check = now + self.check_interval
+            if all(_mtime(p) == t for p, t in self._mtimes.items()):
+                return index
+            self._load_maps()
+        elif self._maps_stale:
+            self._load_maps()
+        return self._build_index()
+
+    def _build_index(self):
+        index = {}
+        # lower priority maps go first, so that higher priority ones win
+        for m in reversed(self.maps[1:]):
+            for lang in m:
+                index[lang] = m[lang]
+        index.update(self._trap)
+        self._index = index
+        self._next_check = time.monotonic() + self.check_interval
+        return index
+
+    def __getitem__(self, key):
+        return self._get_index()[key]
+
+    def __contains__(self, key):
+        return key in self._get_index()
+
+    def __len__(self):
+        return len(self._get_index())
+
+    def __iter__(self):
+        return iter(self._get_index())
+
+    def __bool__(self):
+        return bool(self._get_index())
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, self._get_index())
+
+    def get(self, key, default=None):
+        return self._get_index().get(key, default)
+
+    def __setitem__(self, key, value):
+        self._trap[key] = value
+        if self._index is not None:
+            self._index[key] = value
+
+    def __delitem__(self, key):
+        del self._trap[key]
+        self._index = None
 
     def clear(self):
         """Removes all map entries"""
@@ -246,8 +1388,15 @@ class _LangMapCache(ChainMap):
         self.reset_maps()
 
     def reset_maps(self):
-        """Resets the maps to the current PY_SOURCE_HIGHLIGHT_PATH"""
+        """Resets the maps to the current PY_SOURCE_HIGHLIGHT_PATH, which
+        happens on the next look-up.
+        """
+        self._index = None
+        self._maps_stale = True
+
+    def _load_maps(self):
         global PY_SOURCE_HIGHLIGHT_PATH
+        mtimes = {}
         prev = {m.abspath: m for m in self.maps[1:]}
         maps = [self._trap]
         for p in PY_SOURCE_HIGHLIGHT_PATH:
@@ -257,44 +1406,56 @@ class _LangMapCache(ChainMap):
                 pass
             else:
                 p = os.path.join(p, "lang.map")
-            # re-add LangMap if it exists, make a new one if it doesn't
-            if p in prev:
+            mtimes[p] = _mtime(p)
+            # re-add LangMap if it exists and is unmodified, make a new one
+            # if it doesn't
+            if p in prev and mtimes[p] == self._mtimes.get(p):
                 maps.append(prev[p])
             else:
                 maps.append(LangMap(filename=p))
         self.maps = maps
+        self._mtimes = mtimes
+        self._index = None
+        self._maps_stale = False
 
 
 class _PySourceHighlightPath(MutableSequence):
-    """A custom list-like for handling $PY_SOURCE_HIGHLIGHT_PATH"""
+    """A custom list-like for handling $PY_SOURCE_HIGHLIGHT_PATH. The
+    default path is only computed when it is first used, since that may
+    need to read the source-highlight configuration.
+    """
 
     def __init__(self, *args):
-        if args:
-            self._list = args
+        self._list = list(args) if args else None
+
+    def _get_list(self):
+        if self._list is not None:
+            pass
         elif "PY_SOURCE_HIGHLIGHT_PATH" in os.environ:
             self._list = os.environ["PY_SOURCE_HIGHLIGHT_PATH"].split(os.pathsep)
         else:
             self._list = [retrieve_data_dir()]
+        return self._list
 
     def __getitem__(self, item):
-        return self._list[item]
+        return self._get_list()[item]
 
     def __setitem__(self, item, value):
         global LANG_MAP_CACHE
-        self._list[item] = value
+        self._get_list()[item] = value
         LANG_MAP_CACHE.reset_maps()
 
     def __delitem__(self, item):
         global LANG_MAP_CACHE
-        del self._list[item]
+        del self._get_list()[item]
         LANG_MAP_CACHE.reset_maps()
 
     def __len__(self):
-        return len(self._list)
+        return len(self._get_list())
 
     def insert(self, i, item):
         global LANG_MAP_CACHE
-        self._list.insert(i, item)
+        self._get_list().insert(i, item)
         LANG_MAP_CACHE.reset_maps()
 
     def __copy__(self):
@@ -306,6 +1467,7 @@ class _PySourceHighlightPath(MutableSequence):
         return self
 
 
-# We have to initialize in this order
+# We have to initialize in this order. Neither does any work until it is
+# first used, so that importing is fast.
 PY_SOURCE_HIGHLIGHT_PATH = _PySourceHighlightPath()
 LANG_MAP_CACHE = _LangMapCache()
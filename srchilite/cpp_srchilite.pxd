@@ -6,7 +6,7 @@ from libcpp.string cimport string as std_string
 from libcpp.vector cimport vector as std_vector
 from libcpp.utility cimport pair as std_pair
 from libcpp cimport bool as cpp_bool
-from libc.stdint cimport uint32_t
+from libc.stdint cimport uint32_t, uint64_t
 
 #
 # boost shared pointers
@@ -109,16 +109,67 @@ cdef extern from "srchilite/settings.h" namespace "srchilite":
 # Helper classes
 #
 
-cdef extern from "helpers.hpp" namespace "pysrchilite":
+cdef extern from "helpers.hpp" namespace "pysrchilite" nogil:
 
     ctypedef std_pair[std_string, std_string] TokenPair
     ctypedef std_vector[TokenPair] TokenPairs
     ctypedef shared_ptr[TokenPairs] TokenPairsPtr
+    ctypedef std_vector[TokenPairsPtr] TokenPairsPtrs
+
+    std_vector[std_string] TOKEN_TYPE_NAMES
+
+    cdef cppclass TokenColumns:
+        std_vector[uint32_t] types
+        std_vector[uint32_t] starts
+        std_vector[uint32_t] ends
+
+    ctypedef shared_ptr[TokenColumns] TokenColumnsPtr
 
     cdef cppclass LexerGetTokensFormatter:
-        LexerGetTokensFormatter(const std_string, GetTokensPtr)
+        LexerGetTokensFormatter(const std_string, TokenPairsPtr)
 
     ctypedef shared_ptr[LexerGetTokensFormatter] LexerGetTokensFormatterPtr
 
+    cdef cppclass LineState:
+        LineState()
+        HighlightStatePtr state
+
+    cdef cppclass RuleStats:
+        unsigned int state_id
+        size_t index
+        std_string rule
+        std_string elems
+        uint64_t attempts
+        uint64_t successes
+        double seconds
+
+    cdef cppclass Highlighter:
+        Highlighter(const std_string, const std_string) except +
+        const std_string path
+        const std_string file
+        void reset()
+        LineState initial_state()
+        LineState get_state()
+        void set_state(const LineState&)
+        TokenPairsPtr get_tokens(const std_string&) except +
+        TokenPairsPtr get_tokens(const char*, size_t) except +
+        TokenPairsPtr highlight_line(const std_string&, LineState&) except +
+        TokenPairsPtrs get_tokens_many(const std_vector[std_string]&) except +
+        TokenColumnsPtr get_token_columns(const std_string&) except +
+        void enable_profiling() except +
+        std_vector[RuleStats] rule_stats() except +
+
+    cdef cppclass Document:
+        Document()
+        std_vector[std_string] lines
+        TokenPairsPtrs line_tokens
+        std_vector[LineState] states
+        size_t replace_lines(Highlighter&, size_t, size_t,
+                             const std_vector[std_string]&) except +
+
+    cdef cppclass Renderer:
+        Renderer(const std_string, const std_string, const std_string) except +
+        std_string highlight(const std_string&, const std_string&) except +
+
     TokenPairsPtr get_tokens(const std_string, const std_string path,
-                             const std_string file)
+                             const std_string file) except +
@@ -1,8 +1,16 @@
+#include <cstring>
 #include <iostream>
+#include <sstream>
+#include <mutex>
+#include <algorithm>
+#include <chrono>
+#include <set>
 #include "srchilite/langdefmanager.h"
 #include "srchilite/regexrulefactory.h"
 #include "srchilite/sourcehighlighter.h"
 #include "srchilite/formattermanager.h"
+#include "srchilite/highlighttoken.h"
+#include "srchilite/matchingparameters.h"
 
 #include "helpers.hpp"
 
@@ -19,121 +27,443 @@ void LexerGetTokensFormatter::format(
 };
 
 
-TokenPairs ELEMS_TO_TOKENS = TokenPairs();
-
-void fill_elems_to_tokens_() {
+TokenPairs make_elems_to_tokens_() {
   using std::pair;
   using std::make_pair;
 
-  ELEMS_TO_TOKENS.push_back(make_pair("and_but", "Name.Builtin"));
-  ELEMS_TO_TOKENS.push_back(make_pair("argument", "Name.Variable"));
-  ELEMS_TO_TOKENS.push_back(make_pair("assignment", "Operator"));
-  ELEMS_TO_TOKENS.push_back(make_pair("atom", "Name.Entity"));
-  ELEMS_TO_TOKENS.push_back(make_pair("bgcolor", "Text"));
-  ELEMS_TO_TOKENS.push_back(make_pair("bibtex", "Literal.String.Other"));
-  ELEMS_TO_TOKENS.push_back(make_pair("bold", "Generic.Strong"));
-  ELEMS_TO_TOKENS.push_back(make_pair("cbracket", "Punctuation"));
-  ELEMS_TO_TOKENS.push_back(make_pair("classname", "Name.Class"));
-  ELEMS_TO_TOKENS.push_back(make_pair("code", "Generic"));
-  ELEMS_TO_TOKENS.push_back(make_pair("colon", "Punctuation"));
-  ELEMS_TO_TOKENS.push_back(make_pair("comment", "Comment"));
-  ELEMS_TO_TOKENS.push_back(make_pair("context", "Name.Namespace"));
-  ELEMS_TO_TOKENS.push_back(make_pair("context_property", "Name.Property"));
-  ELEMS_TO_TOKENS.push_back(make_pair("constant", "Name.Constant"));
-  ELEMS_TO_TOKENS.push_back(make_pair("costant", "Name.Constant"));
-  ELEMS_TO_TOKENS.push_back(make_pair("cuketag", "Name.Tag"));
-  ELEMS_TO_TOKENS.push_back(make_pair("date", "Literal.Date"));
-  ELEMS_TO_TOKENS.push_back(make_pair("difflines", "Text"));
-  ELEMS_TO_TOKENS.push_back(make_pair("dynamic", "Name.Variable.Instance"));
-  ELEMS_TO_TOKENS.push_back(make_pair("error", "Generic.Error"));
-  ELEMS_TO_TOKENS.push_back(make_pair("file", "Literal.String.Other"));
-  ELEMS_TO_TOKENS.push_back(make_pair("fixed", "Generic.Output"));
-  ELEMS_TO_TOKENS.push_back(make_pair("function", "Name.Function"));
-  ELEMS_TO_TOKENS.push_back(make_pair("gherken", "Name.Variable.Magic"));
-  ELEMS_TO_TOKENS.push_back(make_pair("given", "Name.Entity"));
-  ELEMS_TO_TOKENS.push_back(make_pair("header_variable", "Name.Variable.Magic"));
-  ELEMS_TO_TOKENS.push_back(make_pair("ip", "Literal.String.Other"));
-  ELEMS_TO_TOKENS.push_back(make_pair("italics", "Generic.Emph"));
-  ELEMS_TO_TOKENS.push_back(make_pair("key", "Name.Attribute"));
-  ELEMS_TO_TOKENS.push_back(make_pair("keyquote", "Literal.String.Heredoc"));
-  ELEMS_TO_TOKENS.push_back(make_pair("keyword", "Keyword"));
-  ELEMS_TO_TOKENS.push_back(make_pair("label", "Name.Tag"));
-  ELEMS_TO_TOKENS.push_back(make_pair("layout_object", "Name.Variable.Instance"));
-  ELEMS_TO_TOKENS.push_back(make_pair("layout_property", "Name.Property"));
-  ELEMS_TO_TOKENS.push_back(make_pair("libsource", "Literal.String.Escape"));
-  ELEMS_TO_TOKENS.push_back(make_pair("lineno", "Generic.Prompt"));
-  ELEMS_TO_TOKENS.push_back(make_pair("linenum", "Generic.Prompt"));
-  ELEMS_TO_TOKENS.push_back(make_pair("lyric_command", "Name.Function.Magic"));
-  ELEMS_TO_TOKENS.push_back(make_pair("math", "Literal.String.Other"));
-  ELEMS_TO_TOKENS.push_back(make_pair("meta", "Name.Attribute"));
-  ELEMS_TO_TOKENS.push_back(make_pair("name", "Name"));
-  ELEMS_TO_TOKENS.push_back(make_pair("newfile", "Generic.Inserted"));
-  ELEMS_TO_TOKENS.push_back(make_pair("normal", "Text"));
-  ELEMS_TO_TOKENS.push_back(make_pair("note_duration", "Literal.Date"));
-  ELEMS_TO_TOKENS.push_back(make_pair("number", "Literal.Number"));
-  ELEMS_TO_TOKENS.push_back(make_pair("oldfile", "Generic.Deleted"));
-  ELEMS_TO_TOKENS.push_back(make_pair("optionalargument", "Name.Variable"));
-  ELEMS_TO_TOKENS.push_back(make_pair("path", "Literal.String.Other"));
-  ELEMS_TO_TOKENS.push_back(make_pair("predef_func", "Name.Function"));
-  ELEMS_TO_TOKENS.push_back(make_pair("predef_var", "Name.Variable"));
-  ELEMS_TO_TOKENS.push_back(make_pair("preproc", "Comment.Preproc"));
-  ELEMS_TO_TOKENS.push_back(make_pair("property", "Name.Property"));
-  ELEMS_TO_TOKENS.push_back(make_pair("regexp", "Literal.String.Regex"));
-  ELEMS_TO_TOKENS.push_back(make_pair("selector", "Name.Tag"));
-  ELEMS_TO_TOKENS.push_back(make_pair("scheme", "Name.Builtin"));
-  ELEMS_TO_TOKENS.push_back(make_pair("scheme_value", "Name.Variable"));
-  ELEMS_TO_TOKENS.push_back(make_pair("selector", "Name.Property"));
-  ELEMS_TO_TOKENS.push_back(make_pair("specialchar", "Literal.String.Escape"));
-  ELEMS_TO_TOKENS.push_back(make_pair("special_fun", "Name.Function.Magic"));
-  ELEMS_TO_TOKENS.push_back(make_pair("string", "Literal.String"));
-  ELEMS_TO_TOKENS.push_back(make_pair("symbol", "Literal.String.Symbol"));
-  ELEMS_TO_TOKENS.push_back(make_pair("table", "Name.Namespace"));
-  ELEMS_TO_TOKENS.push_back(make_pair("then", "Name.Builtin"));
-  ELEMS_TO_TOKENS.push_back(make_pair("time", "Literal.Date"));
-  ELEMS_TO_TOKENS.push_back(make_pair("todo", "Comment.Special"));
-  ELEMS_TO_TOKENS.push_back(make_pair("type", "Keyword.Type"));
-  ELEMS_TO_TOKENS.push_back(make_pair("underline", "Generic.Subheading"));
-  ELEMS_TO_TOKENS.push_back(make_pair("url", "Literal.String.Other"));
-  ELEMS_TO_TOKENS.push_back(make_pair("usertype", "Keyword.Declaration"));
-  ELEMS_TO_TOKENS.push_back(make_pair("value", "Literal"));
-  ELEMS_TO_TOKENS.push_back(make_pair("variable", "Name.Variable"));
-  ELEMS_TO_TOKENS.push_back(make_pair("warning", "Generic.Emph"));
-  ELEMS_TO_TOKENS.push_back(make_pair("when", "Name.Builtin"));
+  TokenPairs elems;
+
+  elems.push_back(make_pair("and_but", "Name.Builtin"));
+  elems.push_back(make_pair("argument", "Name.Variable"));
+  elems.push_back(make_pair("assignment", "Operator"));
+  elems.push_back(make_pair("atom", "Name.Entity"));
+  elems.push_back(make_pair("bgcolor", "Text"));
+  elems.push_back(make_pair("bibtex", "Literal.String.Other"));
+  elems.push_back(make_pair("bold", "Generic.Strong"));
+  elems.push_back(make_pair("cbracket", "Punctuation"));
+  elems.push_back(make_pair("classname", "Name.Class"));
+  elems.push_back(make_pair("code", "Generic"));
+  elems.push_back(make_pair("colon", "Punctuation"));
+  elems.push_back(make_pair("comment", "Comment"));
+  elems.push_back(make_pair("context", "Name.Namespace"));
+  elems.push_back(make_pair("context_property", "Name.Property"));
+  elems.push_back(make_pair("constant", "Name.Constant"));
+  elems.push_back(make_pair("costant", "Name.Constant"));
+  elems.push_back(make_pair("cuketag", "Name.Tag"));
+  elems.push_back(make_pair("date", "Literal.Date"));
+  elems.push_back(make_pair("difflines", "Text"));
+  elems.push_back(make_pair("dynamic", "Name.Variable.Instance"));
+  elems.push_back(make_pair("error", "Generic.Error"));
+  elems.push_back(make_pair("file", "Literal.String.Other"));
+  elems.push_back(make_pair("fixed", "Generic.Output"));
+  elems.push_back(make_pair("function", "Name.Function"));
+  elems.push_back(make_pair("gherken", "Name.Variable.Magic"));
+  elems.push_back(make_pair("given", "Name.Entity"));
+  elems.push_back(make_pair("header_variable", "Name.Variable.Magic"));
+  elems.push_back(make_pair("ip", "Literal.String.Other"));
+  elems.push_back(make_pair("italics", "Generic.Emph"));
+  elems.push_back(make_pair("key", "Name.Attribute"));
+  elems.push_back(make_pair("keyquote", "Literal.String.Heredoc"));
+  elems.push_back(make_pair("keyword", "Keyword"));
+  elems.push_back(make_pair("label", "Name.Tag"));
+  elems.push_back(make_pair("layout_object", "Name.Variable.Instance"));
+  elems.push_back(make_pair("layout_property", "Name.Property"));
+  elems.push_back(make_pair("libsource", "Literal.String.Escape"));
+  elems.push_back(make_pair("lineno", "Generic.Prompt"));
+  elems.push_back(make_pair("linenum", "Generic.Prompt"));
+  elems.push_back(make_pair("lyric_command", "Name.Function.Magic"));
+  elems.push_back(make_pair("math", "Literal.String.Other"));
+  elems.push_back(make_pair("meta", "Name.Attribute"));
+  elems.push_back(make_pair("name", "Name"));
+  elems.push_back(make_pair("newfile", "Generic.Inserted"));
+  elems.push_back(make_pair("normal", "Text"));
+  elems.push_back(make_pair("note_duration", "Literal.Date"));
+  elems.push_back(make_pair("number", "Literal.Number"));
+  elems.push_back(make_pair("oldfile", "Generic.Deleted"));
+  elems.push_back(make_pair("optionalargument", "Name.Variable"));
+  elems.push_back(make_pair("path", "Literal.String.Other"));
+  elems.push_back(make_pair("predef_func", "Name.Function"));
+  elems.push_back(make_pair("predef_var", "Name.Variable"));
+  elems.push_back(make_pair("preproc", "Comment.Preproc"));
+  elems.push_back(make_pair("property", "Name.Property"));
+  elems.push_back(make_pair("regexp", "Literal.String.Regex"));
+  elems.push_back(make_pair("selector", "Name.Tag"));
+  elems.push_back(make_pair("scheme", "Name.Builtin"));
+  elems.push_back(make_pair("scheme_value", "Name.Variable"));
+  elems.push_back(make_pair("selector", "Name.Property"));
+  elems.push_back(make_pair("specialchar", "Literal.String.Escape"));
+  elems.push_back(make_pair("special_fun", "Name.Function.Magic"));
+  elems.push_back(make_pair("string", "Literal.String"));
+  elems.push_back(make_pair("symbol", "Literal.String.Symbol"));
+  elems.push_back(make_pair("table", "Name.Namespace"));
+  elems.push_back(make_pair("then", "Name.Builtin"));
+  elems.push_back(make_pair("time", "Literal.Date"));
+  elems.push_back(make_pair("todo", "Comment.Special"));
+  elems.push_back(make_pair("type", "Keyword.Type"));
+  elems.push_back(make_pair("underline", "Generic.Subheading"));
+  elems.push_back(make_pair("url", "Literal.String.Other"));
+  elems.push_back(make_pair("usertype", "Keyword.Declaration"));
+  elems.push_back(make_pair("value", "Literal"));
+  elems.push_back(make_pair("variable", "Name.Variable"));
+  elems.push_back(make_pair("warning", "Generic.Emph"));
+  elems.push_back(make_pair("when", "Name.Builtin"));
+  return elems;
 }
 
-TokenPairsPtr get_tokens(const std::string code, const std::string path,
-                         const std::string file) {
-  // some initial data setup
-  srchilite::RegexRuleFactory rule_factory;
-  srchilite::LangDefManager lang_def_manager(&rule_factory);
-  srchilite::SourceHighlighter highlighter(lang_def_manager.getHighlightState(
-    path, file));
-  // make format manager
-  TokenPairsPtr tokens (new TokenPairs);
-  srchilite::FormatterManager formatter_manager(LexerGetTokensFormatterPtr(
-    new LexerGetTokensFormatter("Other", tokens)));
-  // fill up the format manager
-  if (ELEMS_TO_TOKENS.size() == 0) {
-    fill_elems_to_tokens_();
+// filled in once, at load time, so that highlighters in different threads
+// never race to initialize it
+const TokenPairs ELEMS_TO_TOKENS = make_elems_to_tokens_();
+
+std::vector<std::string> make_token_type_names_() {
+  std::vector<std::string> names;
+  names.push_back("Other");
+  names.push_back("Text");
+  for (auto token_pair=ELEMS_TO_TOKENS.begin(); token_pair != ELEMS_TO_TOKENS.end(); ++token_pair) {
+    if (std::find(names.begin(), names.end(), token_pair->second) == names.end()) {
+      names.push_back(token_pair->second);
+    }
+  }
+  return names;
+}
+
+const std::vector<std::string> TOKEN_TYPE_NAMES = make_token_type_names_();
+
+
+std::map<std::string, uint32_t> make_token_type_ids_() {
+  std::map<std::string, uint32_t> ids;
+  for (uint32_t i = 0; i < TOKEN_TYPE_NAMES.size(); ++i) {
+    ids[TOKEN_TYPE_NAMES[i]] = i;
+  }
+  return ids;
+}
+
+const std::map<std::string, uint32_t> TOKEN_TYPE_IDS = make_token_type_ids_();
+
+
+uint32_t count_code_points(const std::string &s) {
+  uint32_t n = 0;
+  for (auto c=s.begin(); c != s.end(); ++c) {
+    // skip UTF-8 continuation bytes
+    if ((*c & 0xC0) != 0x80)
+      ++n;
+  }
+  return n;
+}
+
+
+TokenColumnsPtr token_pairs_to_columns(const TokenPairs &tokens) {
+  TokenColumnsPtr columns (new TokenColumns);
+  columns->types.reserve(tokens.size());
+  columns->starts.reserve(tokens.size());
+  columns->ends.reserve(tokens.size());
+  uint32_t offset = 0;
+  for (auto token=tokens.begin(); token != tokens.end(); ++token) {
+    auto id = TOKEN_TYPE_IDS.find(token->first);
+    // unknown types fall back to "Other", which is always id 0
+    columns->types.push_back(id == TOKEN_TYPE_IDS.end() ? 0 : id->second);
+    columns->starts.push_back(offset);
+    offset += count_code_points(token->second);
+    columns->ends.push_back(offset);
   }
+  return columns;
+}
+
+
+// the lang file parser in source-highlight keeps global state, so only
+// one language may be loaded at a time
+std::mutex LANG_DEF_MUTEX;
+
+
+srchilite::HighlightStatePtr load_highlight_state(
+    srchilite::LangDefManager &lang_def_manager, const std::string &path,
+    const std::string &file)
+{
+  std::lock_guard<std::mutex> lock(LANG_DEF_MUTEX);
+  return lang_def_manager.getHighlightState(path, file);
+}
+
+ProfilingRule::ProfilingRule(srchilite::HighlightRulePtr inner_,
+                             RuleStatsPtr stats_) :
+  inner(inner_),
+  stats(stats_)
+{
+  // the highlighter reads these off of the matching rule
+  const srchilite::ElemList &elems = inner->getElemList();
+  for (auto elem = elems.begin(); elem != elems.end(); ++elem) {
+    addElem(*elem);
+  }
+  setNextState(inner->getNextState());
+  setExitLevel(inner->getExitLevel());
+  setNested(inner->isNested());
+  setNeedsReferenceReplacement(inner->getNeedsReferenceReplacement());
+  setHasSubexpressions(inner->getHasSubexpressions());
+  setAdditionalInfo(inner->getAdditionalInfo());
+}
+
+
+bool ProfilingRule::tryToMatch(std::string::const_iterator start,
+                               std::string::const_iterator end,
+                               srchilite::HighlightToken &token,
+                               const srchilite::MatchingParameters &params)
+{
+  auto t0 = std::chrono::steady_clock::now();
+  bool matched = inner->tryToMatch(start, end, token, params);
+  std::chrono::duration<double> dt = std::chrono::steady_clock::now() - t0;
+  stats->attempts++;
+  stats->seconds += dt.count();
+  if (matched) {
+    stats->successes++;
+  }
+  return matched;
+}
+
+
+const std::string ProfilingRule::toString() const {
+  return inner->toString();
+}
+
+
+void ProfilingRule::replaceReferences(const srchilite::ReplacementList &rep) {
+  inner->replaceReferences(rep);
+}
+
+
+srchilite::HighlightRule *ProfilingRule::clone() {
+  return new ProfilingRule(srchilite::HighlightRulePtr(inner->clone()), stats);
+}
+
+
+Highlighter::Highlighter(const std::string path_, const std::string file_) :
+  rule_factory(),
+  lang_def_manager(&rule_factory),
+  main_state(load_highlight_state(lang_def_manager, path_, file_)),
+  tokens(new TokenPairs),
+  formatter_manager(LexerGetTokensFormatterPtr(
+    new LexerGetTokensFormatter("Other", tokens))),
+  highlighter(main_state),
+  path(path_),
+  file(file_)
+{
+  // fill up the format manager
   for (auto token_pair=ELEMS_TO_TOKENS.begin(); token_pair != ELEMS_TO_TOKENS.end(); ++token_pair) {
     formatter_manager.addFormatter(token_pair->first, LexerGetTokensFormatterPtr(
       new LexerGetTokensFormatter(token_pair->second, tokens)));
   }
   highlighter.setFormatterManager(&formatter_manager);
+}
+
+
+void Highlighter::enable_profiling() {
+  if (!profile.empty())
+    return;
+  std::set<unsigned int> seen;
+  std::vector<srchilite::HighlightStatePtr> todo(1, main_state);
+  while (!todo.empty()) {
+    srchilite::HighlightStatePtr state = todo.back();
+    todo.pop_back();
+    if (!state || seen.count(state->getId()))
+      continue;
+    seen.insert(state->getId());
+    const srchilite::RuleList &rules = state->getRuleList();
+    for (srchilite::RuleList::size_type i = 0; i < rules.size(); ++i) {
+      srchilite::HighlightRulePtr rule = rules[i];
+      todo.push_back(rule->getNextState());
+      RuleStatsPtr stats(new RuleStats());
+      stats->state_id = state->getId();
+      stats->index = i;
+      stats->rule = rule->toString();
+      const srchilite::ElemList &elems = rule->getElemList();
+      for (auto elem = elems.begin(); elem != elems.end(); ++elem) {
+        if (!stats->elems.empty())
+          stats->elems += ",";
+        stats->elems += *elem;
+      }
+      profile.push_back(stats);
+      state->replaceRule(i, srchilite::HighlightRulePtr(new ProfilingRule(rule, stats)));
+    }
+  }
+}
+
+
+std::vector<RuleStats> Highlighter::rule_stats() {
+  std::vector<RuleStats> rtn;
+  for (auto stats = profile.begin(); stats != profile.end(); ++stats) {
+    rtn.push_back(**stats);
+  }
+  return rtn;
+}
+
+
+void Highlighter::reset() {
+  highlighter.clearStateStack();
+  highlighter.setCurrentState(main_state);
+  tokens->clear();
+}
+
+
+void Highlighter::highlight_paragraph(const std::string &line) {
+  highlighter.highlightParagraph(line);
+  tokens->push_back(std::make_pair("Text", "\n"));
+}
+
+
+TokenPairsPtr Highlighter::take_tokens() {
+  // hand the tokens off, leaving the formatters with an empty buffer
+  TokenPairsPtr rtn (new TokenPairs);
+  rtn->swap(*tokens);
+  return rtn;
+}
+
+
+bool operator==(const LineState &a, const LineState &b) {
+  return a.state == b.state && a.stack == b.stack;
+}
+
+
+bool operator!=(const LineState &a, const LineState &b) {
+  return !(a == b);
+}
+
+
+LineState Highlighter::initial_state() {
+  LineState state;
+  state.state = main_state;
+  return state;
+}
+
+
+LineState Highlighter::get_state() {
+  LineState state;
+  state.state = highlighter.getCurrentState();
+  state.stack = *highlighter.getStateStack();
+  return state;
+}
+
+
+void Highlighter::set_state(const LineState &state) {
+  if (!state.state) {
+    // a default state is the start of the input
+    reset();
+    return;
+  }
+  highlighter.setCurrentState(state.state);
+  highlighter.setStateStack(srchilite::HighlightStateStackPtr(
+    new srchilite::HighlightStateStack(state.stack)));
+  tokens->clear();
+}
+
+
+TokenPairsPtr Highlighter::get_tokens(const std::string &code) {
+  return get_tokens(code.data(), code.size());
+}
 
-         // make sure it uses additional information
-  //       srchilite::FormatterParams params;
-  //       highlighter.setFormatterParams(&params);
 
-  // we now highlight a line a time
+TokenPairsPtr Highlighter::get_tokens(const char *data, size_t size) {
+  reset();
+  // we now highlight a line a time, straight out of the buffer
+  const char *end = data + size;
   std::string line;
-  std::stringstream codestream(code);
-  while (std::getline(codestream, line)) {
-    highlighter.highlightParagraph(line);
-    tokens->push_back(std::make_pair("Text", "\n"));
+  while (data < end) {
+    const char *newline = static_cast<const char*>(memchr(data, '\n', end - data));
+    const char *stop = (newline == NULL) ? end : newline;
+    line.assign(data, stop - data);
+    highlight_paragraph(line);
+    data = (newline == NULL) ? end : newline + 1;
   }
-  return tokens;
+  return take_tokens();
+}
+
+
+TokenColumnsPtr Highlighter::get_token_columns(const std::string &code) {
+  TokenPairsPtr pairs = get_tokens(code);
+  return token_pairs_to_columns(*pairs);
+}
+
+
+TokenPairsPtr Highlighter::highlight_line(const std::string &line,
+                                          LineState &state) {
+  set_state(state);
+  highlight_paragraph(line);
+  state = get_state();
+  return take_tokens();
+}
+
+
+TokenPairsPtrs Highlighter::get_tokens_many(
+    const std::vector<std::string> &codes)
+{
+  TokenPairsPtrs rtn;
+  rtn.reserve(codes.size());
+  for (auto code=codes.begin(); code != codes.end(); ++code) {
+    rtn.push_back(get_tokens(*code));
+  }
+  return rtn;
+}
+
+
+size_t Document::replace_lines(Highlighter &highlighter, size_t start,
+                               size_t stop,
+                               const std::vector<std::string> &new_lines)
+{
+  size_t nnew = new_lines.size();
+  stop = std::min(stop, lines.size());
+  start = std::min(start, stop);
+  // the state that the first line after the edit used to start in
+  LineState cached = (stop == 0) ? highlighter.initial_state() : states[stop - 1];
+  lines.erase(lines.begin() + start, lines.begin() + stop);
+  lines.insert(lines.begin() + start, new_lines.begin(), new_lines.end());
+  line_tokens.erase(line_tokens.begin() + start, line_tokens.begin() + stop);
+  line_tokens.insert(line_tokens.begin() + start, nnew, TokenPairsPtr());
+  states.erase(states.begin() + start, states.begin() + stop);
+  states.insert(states.begin() + start, nnew, LineState());
+  // re-highlight from the start of the edit
+  LineState state = (start == 0) ? highlighter.initial_state() : states[start - 1];
+  size_t i = start;
+  for (; i < lines.size(); ++i) {
+    if (i >= start + nnew && state == cached) {
+      // the rest of the document is highlighted just as before
+      break;
+    }
+    line_tokens[i] = highlighter.highlight_line(lines[i], state);
+    if (i >= start + nnew) {
+      cached = states[i];
+    }
+    states[i] = state;
+  }
+  return i;
+}
+
+
+Renderer::Renderer(const std::string data_dir, const std::string outlang,
+                   const std::string style) :
+  source_highlight(outlang)
+{
+  source_highlight.setDataDir(data_dir);
+  source_highlight.setStyleFile(style);
+  std::lock_guard<std::mutex> lock(LANG_DEF_MUTEX);
+  source_highlight.initialize();
+}
+
+
+std::string Renderer::highlight(const std::string &code,
+                                const std::string &lang_file) {
+  std::istringstream input(code);
+  std::ostringstream output;
+  {
+    // SourceHighlight::highlight() parses the lang file itself, with the
+    // parser's global state, and offers no way to hand it a prebuilt state,
+    // so the lock cannot be narrowed to just the load here
+    std::lock_guard<std::mutex> lock(LANG_DEF_MUTEX);
+    source_highlight.highlight(input, output, lang_file);
+  }
+  return output.str();
+}
+
+
+TokenPairsPtr get_tokens(const std::string code, const std::string path,
+                         const std::string file) {
+  Highlighter highlighter(path, file);
+  return highlighter.get_tokens(code);
 }
 
 } // end pysrchilite
\ No newline at end of file
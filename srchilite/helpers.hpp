@@ -1,6 +1,8 @@
 #ifndef PYSRCHILITE_HELPERS_H
 #define PYSRCHILITE_HELPERS_H
 
+#include <cstdint>
+#include <map>
 #include <utility>
 #include <string>
 #include <vector>
@@ -8,6 +10,13 @@
 #include "boost/shared_ptr.hpp"
 
 #include "srchilite/formatter.h"
+#include "srchilite/formattermanager.h"
+#include "srchilite/highlightrule.h"
+#include "srchilite/highlightstate.h"
+#include "srchilite/langdefmanager.h"
+#include "srchilite/regexrulefactory.h"
+#include "srchilite/sourcehighlight.h"
+#include "srchilite/sourcehighlighter.h"
 
 
 namespace pysrchilite {
@@ -15,10 +24,30 @@ namespace pysrchilite {
 typedef std::pair<std::string, std::string> TokenPair;
 typedef std::vector<TokenPair> TokenPairs;
 typedef boost::shared_ptr<TokenPairs> TokenPairsPtr;
+typedef std::vector<TokenPairsPtr> TokenPairsPtrs;
 
-extern TokenPairs ELEMS_TO_TOKENS;
+extern const TokenPairs ELEMS_TO_TOKENS;
 
-void fill_elems_to_tokens_();
+TokenPairs make_elems_to_tokens_();
+
+// The fixed table of token type names that token type ids index into
+extern const std::vector<std::string> TOKEN_TYPE_NAMES;
+extern const std::map<std::string, uint32_t> TOKEN_TYPE_IDS;
+
+std::vector<std::string> make_token_type_names_();
+std::map<std::string, uint32_t> make_token_type_ids_();
+
+// Tokens as columns of type ids and [start, end) offsets, which count
+// code points (not bytes) into the highlighted code
+struct TokenColumns {
+  std::vector<uint32_t> types;
+  std::vector<uint32_t> starts;
+  std::vector<uint32_t> ends;
+};
+
+typedef boost::shared_ptr<TokenColumns> TokenColumnsPtr;
+
+TokenColumnsPtr token_pairs_to_columns(const TokenPairs &tokens);
 
 class LexerGetTokensFormatter: public srchilite::Formatter {
  private:
@@ -38,6 +67,131 @@ class LexerGetTokensFormatter: public srchilite::Formatter {
 typedef boost::shared_ptr<LexerGetTokensFormatter> LexerGetTokensFormatterPtr;
 
 
+// The highlighter state in between two lines of input
+struct LineState {
+  srchilite::HighlightStatePtr state;
+  srchilite::HighlightStateStack stack;
+};
+
+bool operator==(const LineState &a, const LineState &b);
+bool operator!=(const LineState &a, const LineState &b);
+
+
+// Match attempts, successes, and cumulative match time of one rule in a
+// highlight state, as collected by a ProfilingRule
+struct RuleStats {
+  unsigned int state_id;
+  size_t index;
+  std::string rule;
+  std::string elems;
+  uint64_t attempts;
+  uint64_t successes;
+  double seconds;
+
+  RuleStats() : state_id(0), index(0), attempts(0), successes(0), seconds(0.0) {};
+};
+
+typedef boost::shared_ptr<RuleStats> RuleStatsPtr;
+
+
+// Wraps a highlight rule, counting and timing its match attempts. Clones,
+// such as those made for back-references, share the stats of the original.
+class ProfilingRule: public srchilite::HighlightRule {
+ private:
+  srchilite::HighlightRulePtr inner;
+  RuleStatsPtr stats;
+
+ public:
+  ProfilingRule(srchilite::HighlightRulePtr inner_, RuleStatsPtr stats_);
+
+  using srchilite::HighlightRule::tryToMatch;
+  virtual bool tryToMatch(std::string::const_iterator start,
+                          std::string::const_iterator end,
+                          srchilite::HighlightToken &token,
+                          const srchilite::MatchingParameters &params);
+  virtual const std::string toString() const;
+  virtual void replaceReferences(const srchilite::ReplacementList &rep);
+  virtual srchilite::HighlightRule *clone();
+};
+
+
+// Keeps a compiled language definition around so that it may be used to
+// highlight many inputs without reparsing the lang file each time.
+class Highlighter {
+ private:
+  srchilite::RegexRuleFactory rule_factory;
+  srchilite::LangDefManager lang_def_manager;
+  srchilite::HighlightStatePtr main_state;
+  TokenPairsPtr tokens;
+  std::vector<RuleStatsPtr> profile;
+  srchilite::FormatterManager formatter_manager;
+  srchilite::SourceHighlighter highlighter;
+
+  void highlight_paragraph(const std::string &line);
+  TokenPairsPtr take_tokens();
+
+ public:
+  const std::string path;
+  const std::string file;
+
+  Highlighter(const std::string path_, const std::string file_);
+
+  // puts the highlighter back into the main state
+  void reset();
+
+  LineState initial_state();
+  LineState get_state();
+  void set_state(const LineState &state);
+
+  TokenPairsPtr get_tokens(const std::string &code);
+  TokenPairsPtr get_tokens(const char *data, size_t size);
+
+  // highlights a single line (without its newline), starting from and then
+  // updating the given state
+  TokenPairsPtr highlight_line(const std::string &line, LineState &state);
+
+  // highlights each of the codes separately, in a single call
+  TokenPairsPtrs get_tokens_many(const std::vector<std::string> &codes);
+
+  TokenColumnsPtr get_token_columns(const std::string &code);
+
+  // wraps every rule reachable from the main state in a ProfilingRule
+  void enable_profiling();
+  std::vector<RuleStats> rule_stats();
+};
+
+
+// Highlighted lines of a document, along with the state at the end of each
+// line, so that edits only need to re-highlight the lines that they affect.
+class Document {
+ public:
+  std::vector<std::string> lines;
+  TokenPairsPtrs line_tokens;
+  std::vector<LineState> states;
+
+  // replaces the lines in [start, stop) with new_lines, re-highlights until
+  // the state at the start of a line matches what it was before the edit,
+  // and returns the (new) index of the first line that was not re-highlighted
+  size_t replace_lines(Highlighter &highlighter, size_t start, size_t stop,
+                       const std::vector<std::string> &new_lines);
+};
+
+
+// Renders code straight to a string with source-highlight's own formatters,
+// as configured by an output language and a style file. Both are only loaded
+// once, when the renderer is made.
+class Renderer {
+ private:
+  srchilite::SourceHighlight source_highlight;
+
+ public:
+  Renderer(const std::string data_dir, const std::string outlang,
+           const std::string style);
+
+  std::string highlight(const std::string &code, const std::string &lang_file);
+};
+
+
 TokenPairsPtr get_tokens(const std::string code, const std::string path,
                         const std::string file);
 
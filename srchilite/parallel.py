@@ -0,0 +1,84 @@
+"""Highlighting many files at once, spread over a pool of processes."""
+import os
+
+from srchilite import bindings
+
+
+def iter_files(paths):
+    """Yields the files in paths, walking any directories that are given."""
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for f in sorted(files):
+                    yield os.path.join(root, f)
+        else:
+            yield path
+
+
+def _init_worker(highlight_path):
+    if list(bindings.PY_SOURCE_HIGHLIGHT_PATH) != highlight_path:
+        bindings.PY_SOURCE_HIGHLIGHT_PATH[:] = highlight_path
+
+
+def _highlight_chunk(paths):
+    # Highlighters stay in the worker's pool between chunks, so each
+    # language is only loaded once per worker.
+    results = []
+    for path in paths:
+        try:
+            lang = bindings._guess_file_lang(path)
+            tokens = bindings.highlight_file(path, lang)
+        except (OSError, ValueError, RuntimeError):
+            # one unreadable file should not end the whole stream
+            tokens = None
+        results.append((path, tokens))
+    return results
+
+
+def highlight_paths(paths, workers=None, chunksize=16):
+    """Generator that highlights files over a pool of worker processes,
+    yielding (path, tokens) pairs as they finish. The language of each file
+    is guessed from its name and contents, as with guess_lang; tokens is None
+    for files whose language could not be guessed, or that could not be read
+    or highlighted.
+
+    Parameters
+    ----------
+    paths : str or iterable of str
+        Files and directories to highlight. Directories are walked.
+    workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    chunksize : int, optional
+        The number of files sent to a worker at a time.
+    """
+    # imported here, since multiprocessing is slow to import
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+    workers = workers or os.cpu_count() or 1
+    highlight_path = list(bindings.PY_SOURCE_HIGHLIGHT_PATH)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(highlight_path,)) as executor:
+        # bound the number of chunks in flight, so that results are streamed
+        # back rather than piling up for large trees
+        max_pending = 2 * workers
+        pending = set()
+        chunk = []
+        for path in iter_files(paths):
+            chunk.append(path)
+            if len(chunk) < chunksize:
+                continue
+            pending.add(executor.submit(_highlight_chunk, chunk))
+            chunk = []
+            while len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        if chunk:
+            pending.add(executor.submit(_highlight_chunk, chunk))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
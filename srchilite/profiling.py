@@ -0,0 +1,60 @@
+"""Profiling the rules of a language definition on a corpus of code, to find
+the regexes that highlighting spends its time in. This may also be run as
+
+    python -m srchilite.profiling LANG PATH [PATH ...]
+"""
+import sys
+import argparse
+
+from srchilite import bindings
+from srchilite.parallel import iter_files
+
+
+def profile_rules(codes, lang="", filename="", path=None):
+    """Highlights each code in an iterable of codes and returns a RuleProfile
+    for every rule in the language, ranked by the time spent matching it.
+    """
+    highlighter = bindings.Highlighter(lang=lang, filename=filename, path=path)
+    highlighter.enable_profiling()
+    for code in codes:
+        highlighter.get_tokens(code)
+    return highlighter.rule_profile()
+
+
+def _read_files(paths):
+    for fname in iter_files(paths):
+        with open(fname, "rb") as f:
+            yield f.read()
+
+
+def format_profile(profile, top=None):
+    """Returns a table of rule profiles, as a str"""
+    total = sum(p.seconds for p in profile) or 1.0
+    lines = ["{0:>10} {1:>6} {2:>10} {3:>10} {4:>6} {5}".format(
+        "seconds", "%", "attempts", "successes", "state", "rule")]
+    for p in profile[:top]:
+        rule = p.rule if len(p.rule) <= 80 else p.rule[:77] + "..."
+        lines.append("{0:>10.6f} {1:>6.1%} {2:>10} {3:>10} {4:>6} {5}".format(
+            p.seconds, p.seconds / total, p.attempts, p.successes,
+            "{0}:{1}".format(p.state, p.index), rule))
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("lang", help="language name, or lang file with --file")
+    parser.add_argument("paths", nargs="+", help="files or directories of code")
+    parser.add_argument("--file", action="store_true",
+                        help="treat lang as the path to a lang file")
+    parser.add_argument("-n", "--top", type=int, default=20,
+                        help="number of rules to show, 0 for all")
+    ns = parser.parse_args(args)
+    if ns.file:
+        profile = profile_rules(_read_files(ns.paths), filename=ns.lang)
+    else:
+        profile = profile_rules(_read_files(ns.paths), lang=ns.lang)
+    sys.stdout.write(format_profile(profile, top=ns.top or None) + "\n")
+
+
+if __name__ == "__main__":
+    main()
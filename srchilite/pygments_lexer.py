@@ -0,0 +1,59 @@
+"""A Pygments lexer backed by source-highlight, so that code using Pygments
+formatters may lex at native speed. This module requires Pygments.
+"""
+from pygments.lexer import Lexer
+from pygments.token import string_to_tokentype
+
+from srchilite import bindings
+
+
+# Pygments token types, indexed by the type ids in a TokenArray
+PYGMENTS_TOKEN_TYPES = tuple(string_to_tokentype(".".join(token))
+                             for token in bindings.TOKEN_TYPES)
+
+
+class SrcHiliteLexer(Lexer):
+    """Pygments lexer that tokenizes with source-highlight.
+
+    Parameters
+    ----------
+    lang : str, optional
+        The language name, as found in LANG_MAP_CACHE.
+    filename : str, optional
+        The lang file to use, if lang is not given.
+    path : str, optional
+        The directory to search for the filename in.
+    options :
+        Pygments lexer options, such as stripnl or tabsize.
+    """
+
+    name = "source-highlight"
+    aliases = []
+    filenames = []
+
+    def __init__(self, lang="", filename="", path=None, **options):
+        super().__init__(**options)
+        self.lang = lang
+        self.path, self.filename = bindings._resolve_lang_file(lang, filename, path)
+
+    def __repr__(self):
+        return "<SrcHiliteLexer lang={0!r} filename={1!r}>".format(self.lang,
+                                                                 self.filename)
+
+    def get_tokens_unprocessed(self, text):
+        """Yields (offset, tokentype, value) tuples. The offsets are computed
+        natively, as part of highlighting.
+        """
+        highlighter = bindings.HIGHLIGHTER_POOL.get(self.path, self.filename)
+        tokens = highlighter.get_token_array(text)
+        types = tokens.types
+        starts = tokens.starts
+        ends = tokens.ends
+        n = len(text)
+        for i in range(len(types)):
+            start = starts[i]
+            if start >= n:
+                # the newline that the highlighter ends the last line with
+                break
+            end = min(ends[i], n)
+            yield start, PYGMENTS_TOKEN_TYPES[types[i]], text[start:end]
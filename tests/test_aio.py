@@ -0,0 +1,67 @@
+import asyncio
+import threading
+
+from srchilite import get_tokens
+from srchilite.aio import AsyncHighlighter, aget_tokens, aiter_tokens
+
+
+CODE = "print('hello')\n" "x = 1\n"
+
+
+def test_aget_tokens():
+    obs = asyncio.run(aget_tokens(CODE, "py"))
+    assert obs == get_tokens(CODE, "py")
+
+
+def test_aiter_tokens():
+    async def collect():
+        highlighter = AsyncHighlighter(max_workers=2, queue_size=1, chunk_lines=1)
+        try:
+            return [token async for token in highlighter.aiter_tokens(CODE * 10, "py")]
+        finally:
+            highlighter.shutdown()
+
+    assert asyncio.run(collect()) == get_tokens(CODE * 10, "py")
+
+
+def test_aiter_tokens_concurrent():
+    async def run():
+        small = asyncio.gather(*[aget_tokens(CODE, "py") for _ in range(8)])
+        big = [token async for token in aiter_tokens(CODE * 100, "py")]
+        return await small, big
+
+    small, big = asyncio.run(run())
+    assert all(s == get_tokens(CODE, "py") for s in small)
+    assert big == get_tokens(CODE * 100, "py")
+
+
+def test_cancel_keeps_concurrency_limit():
+    started = threading.Event()
+    finish = threading.Event()
+
+    def job():
+        started.set()
+        finish.wait(10)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        highlighter = AsyncHighlighter(max_workers=2, concurrency=1)
+        try:
+            task = asyncio.ensure_future(highlighter._run(job))
+            await loop.run_in_executor(None, started.wait, 10)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            assert task.cancelled()
+            # the cancelled job is still running, so it still holds the only
+            # permit, and no other job may start
+            assert highlighter._semaphore().locked()
+            second = asyncio.ensure_future(highlighter.aget_tokens(CODE, "py"))
+            await asyncio.sleep(0.05)
+            assert not second.done()
+            finish.set()
+            return await second
+        finally:
+            finish.set()
+            highlighter.shutdown()
+
+    assert asyncio.run(run()) == get_tokens(CODE, "py")
@@ -1,7 +1,15 @@
 """Tests basic bindings"""
 import os
+import sys
+import subprocess
 
-from srchilite.bindings import retrieve_data_dir, LANG_MAP_CACHE
+import srchilite
+
+from srchilite.bindings import (
+    retrieve_data_dir,
+    LANG_MAP_CACHE,
+    PY_SOURCE_HIGHLIGHT_PATH,
+)
 
 
 def test_retrieve_data_dir():
@@ -14,4 +22,103 @@ def test_lang_map_cache():
     py = LANG_MAP_CACHE['py']
     assert os.path.isabs(py)
     assert 'py' in py
-    assert '.lang' == os.path.splitext(py)[1]
\ No newline at end of file
+    assert '.lang' == os.path.splitext(py)[1]
+
+
+def test_lang_map_cache_reload(tmp_path):
+    lang_map = tmp_path / "lang.map"
+    lang_map.write_text("mylang = mylang.lang\n")
+    PY_SOURCE_HIGHLIGHT_PATH.insert(0, str(tmp_path))
+    check_interval = LANG_MAP_CACHE.check_interval
+    LANG_MAP_CACHE.check_interval = 0.0
+    try:
+        assert LANG_MAP_CACHE["mylang"] == str(tmp_path / "mylang.lang")
+        assert "otherlang" not in LANG_MAP_CACHE
+        lang_map.write_text("mylang = mylang.lang\notherlang = other.lang\n")
+        os.utime(lang_map, ns=(0, 1))
+        assert LANG_MAP_CACHE["otherlang"] == str(tmp_path / "other.lang")
+    finally:
+        LANG_MAP_CACHE.check_interval = check_interval
+        del PY_SOURCE_HIGHLIGHT_PATH[0]
+    assert "mylang" not in LANG_MAP_CACHE
+
+
+def test_lazy_import(tmp_path):
+    # the path and lang maps are only read when first used, so that they may
+    # still be set up after importing
+    (tmp_path / "lang.map").write_text("mylang = my.lang\n")
+    code = (
+        "import os, sys\n"
+        "import srchilite\n"
+        "assert 'concurrent.futures.process' not in sys.modules\n"
+        "os.environ['PY_SOURCE_HIGHLIGHT_PATH'] = {0!r}\n"
+        "assert srchilite.LANG_MAP_CACHE\n"
+        "assert 'mylang' in repr(srchilite.LANG_MAP_CACHE)\n"
+        "assert srchilite.LANG_MAP_CACHE['mylang'].endswith('my.lang')\n"
+    ).format(str(tmp_path))
+    env = dict(os.environ)
+    env.pop("PY_SOURCE_HIGHLIGHT_PATH", None)
+    subprocess.run([sys.executable, "-c", code], check=True, env=env)
+
+
+def test_stats():
+    events = []
+    srchilite.reset_stats()
+    srchilite.enable_stats(lambda *args: events.append(args))
+    try:
+        srchilite.get_tokens("x = 1\n", "py")
+        srchilite.get_tokens("y = 2\n", "py")
+        obs = srchilite.stats()
+    finally:
+        srchilite.disable_stats()
+        srchilite.reset_stats()
+    assert obs["phases"]["highlight"]["calls"] == 2
+    assert obs["phases"]["convert"]["calls"] == 2
+    assert obs["phases"]["lang_map"]["calls"] == 2
+    lang = obs["langs"]["python.lang"]
+    assert lang["bytes"] == 12
+    assert lang["tokens"] > 0
+    assert obs["caches"]["pool"]["hits"] >= 1
+    assert ("highlight", "python.lang") in {e[:2] for e in events}
+    assert srchilite.stats()["langs"] == {}
+
+
+def test_stats_lines_and_documents():
+    srchilite.reset_stats()
+    srchilite.enable_stats()
+    try:
+        list(srchilite.iter_tokens(["x = 1\n", "y = 2\n"], "py"))
+        doc = srchilite.Document("x = 1\n", "py")
+        doc.replace_lines(0, 1, ["y = 22"])
+        obs = srchilite.stats()
+    finally:
+        srchilite.disable_stats()
+        srchilite.reset_stats()
+    assert obs["phases"]["highlight"]["calls"] == 4
+    lang = obs["langs"]["python.lang"]
+    assert lang["bytes"] == 6 + 6 + 6 + 7
+    assert lang["tokens"] > 0
+
+
+def test_token_type():
+    from srchilite import Token
+    from srchilite.bindings import string_to_token, token_from_id
+
+    token = Token.Literal.String.Double
+    assert token in Token.Literal.String
+    assert token in Token
+    assert token in token
+    assert Token.Literal not in token
+    assert Token.Name not in Token.Literal
+    assert token.parent is Token.Literal.String
+    assert token.split() == [Token, Token.Literal, Token.Literal.String, token]
+    assert token in Token.Literal.String.subtypes
+    assert string_to_token("Literal.String.Double") is token
+    assert isinstance(token.id, int) and token.id != Token.Literal.id
+    assert tuple(token) == ("Literal", "String", "Double")
+    assert repr(token) == "Token.Literal.String.Double"
+    assert not hasattr(token, "__dict__")
+    assert not hasattr(token, "_repr_html_")
+    assert not hasattr(token, "lower")
+    assert token_from_id(token.id) is token
+    assert token_from_id(Token.id) is Token
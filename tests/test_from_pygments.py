@@ -0,0 +1,99 @@
+import os
+import re
+import importlib.util
+
+import pytest
+
+pytest.importorskip("pygments")
+pytest.importorskip("exrex")
+pytest.importorskip("xonsh")
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "from-pygments.py")
+
+
+@pytest.fixture(scope="module")
+def fp():
+    spec = importlib.util.spec_from_file_location("from_pygments", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_keyword_trie(fp):
+    regex = r"(if|in|int|else)\b"
+    obs = fp.keyword_trie(regex)
+    assert obs != regex
+    for word in ["if", "in", "int", "else"]:
+        assert re.match(obs, word + " ").group() == word
+    assert re.match(obs, "inside") is None
+    assert fp.keyword_trie(r"\b(for|foreach)\b").startswith(r"\b")
+
+
+def test_keyword_trie_flags(fp):
+    for regex in [r"(?i)(select|from|where)\b", r"(?i:select|from)\b",
+                  r"(?x)(a|b)\b", r"(a|b)\\b", "(a|b)"]:
+        assert fp.keyword_trie(regex) == regex
+
+
+def test_merge_rules(fp):
+    lines = ["keyword = '(if|else)\\b'", "keyword = '(for|while)\\b'",
+             "type = 'int\\b'"]
+    obs = fp._merge_rules(lines)
+    assert len(obs) == 2
+    regex = fp.SIMPLE_RULE_RE.match(obs[0]).group("regex")
+    assert set(fp.literal_words(regex[:-2])) == {"if", "else", "for", "while"}
+    assert obs[1] == lines[2]
+
+
+def test_merge_rules_keeps_order(fp):
+    # either could match first at the same position
+    for lines in [["symbol = 'a+'", "symbol = 'b+'"],
+                  ["keyword = 'in'", "keyword = 'int'"],
+                  ["keyword = '(a|ab)'", "keyword = 'c'"],
+                  ["keyword = '(?i)(if|else)\\b'", "keyword = 'for\\b'"],
+                  ["keyword = 'if\\b'", "keyword = 'for\\b' exit"]]:
+        assert fp._merge_rules(lines) == lines
+    assert len(fp._merge_rules(["keyword = 'in'", "keyword = 'for'"])) == 1
+
+
+def test_optimize_lines(fp):
+    lines = [
+        "keyword = '(if|else|for)\\b'",
+        "state comment = '/\\*' begin",
+        "  comment = 'x'",
+        "  comment = 'x'",
+        "end",
+        "type = 'if\\b'",
+        "symbol = 'x'",
+        "keyword = '(if|else|for|while)\\b'",
+        "keyword = 'if'",
+        "keyword = '(?i)for\\b'",
+    ]
+    obs = fp.optimize_lines(lines)
+    assert obs[1:4] == ["state comment = '/\\*' begin", "  comment = 'x'", "end"]
+    # the type rule can never match, but a superset of the keywords can
+    assert not any(line.startswith("type") for line in obs)
+    assert obs[4] == "symbol = 'x'"
+    assert obs[5].startswith("keyword = ") and obs[5].endswith("\\b'")
+    assert obs[6:] == lines[8:]
+
+
+def test_optimize_lines_standalone_exits(fp):
+    # an exit on its own line belongs to the rule before it
+    lines = ["Token_Keyword = '(if|else)\\b'",
+             "Token_Keyword = '(for|while)\\b'",
+             "exitall",
+             "Token_Name = 'x'"]
+    obs = fp.optimize_lines(lines)
+    assert len(obs) == 3
+    assert "exitall" not in obs[0]
+    assert set(fp.literal_words(
+        fp.SIMPLE_RULE_RE.match(obs[0]).group("regex")[:-2])) == {"if", "else"}
+    assert obs[1] == "Token_Keyword = '(?:for|while)\\b' exitall"
+    assert obs[2] == lines[3]
+    assert len(fp._merge_rules(lines)) == 3
+
+    lines = ["Token_Comment = '/\\*'", "Token_Name = 'abc'",
+             "Token_Comment = '/\\*'", "exitall"]
+    assert fp.optimize_lines(lines) == lines[:2]
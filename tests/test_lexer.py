@@ -1,4 +1,23 @@
-from srchilite import Token, get_tokens
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from srchilite import (
+    Token,
+    get_tokens,
+    get_tokens_many,
+    iter_tokens,
+    get_token_array,
+    highlight_file,
+    guess_lang,
+    highlight,
+    get_highlighter,
+    preload,
+    Highlighter,
+    Document,
+    enable_memo,
+    disable_memo,
+)
 
 
 def test_get_tokens_python():
@@ -19,5 +38,148 @@ def test_get_tokens_python():
     assert obs == exp
 
 
+def test_highlighter_reuse():
+    code = "print('hello')\n" "x = 1\n"
+    highlighter = Highlighter("py")
+    first = highlighter.get_tokens(code)
+    second = highlighter.get_tokens(code)
+    assert first == second == get_tokens(code, "py")
+
+
+def test_get_highlighter_cached():
+    assert get_highlighter("py") is get_highlighter("py")
+
+
+def test_preload():
+    from srchilite.bindings import HIGHLIGHTER_POOL
+
+    HIGHLIGHTER_POOL.clear()
+    preload("py", "c")
+    assert len(HIGHLIGHTER_POOL) == 2
+    get_highlighter("py")
+    assert len(HIGHLIGHTER_POOL) == 2
+
+
+def test_get_tokens_many():
+    codes = ["print('hello')\n", "", "x = 1\n"]
+    obs = get_tokens_many(codes, "py")
+    exp = [get_tokens(code, "py") for code in codes]
+    assert obs == exp
+
+
+def test_iter_tokens():
+    code = "print('hello')\n" "x = 1\n"
+    obs = list(iter_tokens(io.StringIO(code), "py"))
+    assert obs == get_tokens(code, "py")
+    obs = list(iter_tokens(["print('hello')", "x = 1"], "py"))
+    assert obs == get_tokens(code, "py")
+
+
+def test_get_tokens_bytes():
+    code = "print('hello')\n" "x = 1\n"
+    exp = get_tokens(code, "py")
+    assert get_tokens(code.encode(), "py") == exp
+    assert get_tokens(bytearray(code.encode()), "py") == exp
+    assert get_tokens(memoryview(code.encode()), "py") == exp
+
+
+def test_highlight_file(tmp_path):
+    code = "print('hello')\n" "x = 1\n"
+    filename = tmp_path / "hello.py"
+    filename.write_text(code)
+    assert highlight_file(str(filename)) == get_tokens(code, "py")
+
+
+SHARE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                         "share", "py-source-highlight")
+
+
+def test_highlight_esc256():
+    obs = highlight(
+        "int x = 1;\n",
+        filename=os.path.join(SHARE_DIR, "c.lang"),
+        outlang=os.path.join(SHARE_DIR, "monokai_esc256.outlang"),
+        style=os.path.join(SHARE_DIR, "monokai.style"),
+    )
+    assert "\x1b[" in obs
+    assert "int" in obs
+
+
+def test_guess_lang():
+    assert guess_lang(filename="hello.py") == "py"
+    assert guess_lang(filename="HELLO.PY") == "py"
+    assert guess_lang(first_line="#!/usr/bin/env python3") is not None
+    assert guess_lang(first_line="#!/usr/bin/python") == "python"
+    assert guess_lang(first_line="#!/usr/bin/env perl -w") == "perl"
+
+
+def test_interpreter_names():
+    from srchilite.bindings import _interpreter_names
+
+    assert _interpreter_names("python3.7") == ["python3.7", "python3", "python"]
+    assert _interpreter_names("python3") == ["python3", "python"]
+    assert _interpreter_names("ruby2.7.1") == ["ruby2.7.1", "ruby2", "ruby"]
+    assert _interpreter_names("bash") == ["bash"]
+    assert guess_lang(code="diff --git a/x b/x\n") == "diff"
+    assert guess_lang(filename="unknown-ext", code="hello") is None
+
+
+def test_get_token_array():
+    code = "print('hello')\n" "x = 1"
+    obs = get_token_array(code, "py")
+    assert list(obs) == get_tokens(code, "py")
+    assert obs.value(0) == "print"
+    assert obs.token_type(0) is Token.Keyword
+
+
+def test_token_array_type_ids():
+    from srchilite import TOKEN_TYPES
+    from srchilite.bindings import token_from_id
+
+    assert all(token.id == i for i, token in enumerate(TOKEN_TYPES))
+    obs = get_token_array("print('hello')\n", "py")
+    for i in range(len(obs)):
+        assert token_from_id(obs.types[i]) is obs.token_type(i)
+
+
+def test_document_update():
+    code = "print('hello')\n" "x = 1\n" "y = 2\n"
+    doc = Document(code, "py")
+    assert doc.tokens == get_tokens(code, "py")
+    new_code = "print('hello')\n" "x = 10\n" "y = 2\n"
+    delta = doc.update(new_code)
+    assert delta.start == 1
+    assert delta.stop == 2
+    assert delta.lines == [get_tokens("x = 10\n", "py")]
+    assert doc.tokens == get_tokens(new_code, "py")
+
+
+def test_get_tokens_threaded():
+    code = "print('hello')\n" "x = 1\n"
+    exp = get_tokens(code, "py")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(get_tokens, code, "py") for _ in range(16)]
+        for future in futures:
+            assert future.result() == exp
+
+
+def test_get_tokens_memo():
+    code = "x = 1\n"
+    exp = get_tokens(code, "py")
+    memo = enable_memo(maxbytes=1024)
+    try:
+        first = get_tokens(code, "py")
+        second = get_tokens(code, "py")
+        assert isinstance(first, tuple)
+        assert first is second
+        assert list(first) == exp
+        assert len(memo) == 1
+        get_tokens("y = 2\n" * 200, "py")
+        assert memo.nbytes <= 1024
+    finally:
+        disable_memo()
+    assert get_tokens(code, "py") == exp
+
+
 if __name__ == "__main__":
     test_get_tokens_python()
@@ -0,0 +1,29 @@
+import pickle
+
+from srchilite import Token, get_tokens, highlight_paths
+
+
+def test_token_pickle():
+    assert pickle.loads(pickle.dumps(Token.Literal.String)) is Token.Literal.String
+    assert pickle.loads(pickle.dumps(Token)) is Token
+
+
+def test_highlight_paths(tmp_path):
+    code = "print('hello')\n" "x = 1\n"
+    for name in ["a.py", "b.py", "c.unknown-ext"]:
+        (tmp_path / name).write_text(code)
+    obs = dict(highlight_paths([str(tmp_path)], workers=2, chunksize=1))
+    exp = get_tokens(code, "py")
+    assert obs[str(tmp_path / "a.py")] == exp
+    assert obs[str(tmp_path / "b.py")] == exp
+    assert obs[str(tmp_path / "c.unknown-ext")] is None
+
+
+def test_highlight_paths_unreadable(tmp_path):
+    code = "x = 1\n"
+    (tmp_path / "a.py").write_text(code)
+    missing = str(tmp_path / "missing.py")
+    obs = dict(highlight_paths([str(tmp_path / "a.py"), missing], workers=1,
+                               chunksize=2))
+    assert obs[str(tmp_path / "a.py")] == get_tokens(code, "py")
+    assert obs[missing] is None
@@ -0,0 +1,22 @@
+from srchilite import get_tokens
+from srchilite.profiling import profile_rules, format_profile
+
+
+def test_profile_rules():
+    codes = ["x = 1  # one\n", "def f():\n    return 'f'\n"]
+    profile = profile_rules(codes, "py")
+    assert len(profile) > 0
+    assert sum(p.successes for p in profile) > 0
+    assert all(p.attempts >= p.successes for p in profile)
+    seconds = [p.seconds for p in profile]
+    assert seconds == sorted(seconds, reverse=True)
+    assert format_profile(profile, top=3).count("\n") == 3
+
+
+def test_profiling_same_tokens():
+    from srchilite import Highlighter
+
+    code = "def f():\n    return 'f'  # comment\n"
+    highlighter = Highlighter(lang="py")
+    highlighter.enable_profiling()
+    assert highlighter.get_tokens(code) == get_tokens(code, "py")
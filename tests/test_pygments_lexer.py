@@ -0,0 +1,38 @@
+import pytest
+
+pygments = pytest.importorskip("pygments")
+
+from pygments.formatters import NullFormatter
+from pygments.token import Token as PygmentsToken
+
+from srchilite import get_tokens
+from srchilite.pygments_lexer import SrcHiliteLexer
+
+
+CODE = "print('hello')\n" "x = 1\n"
+
+
+def test_get_tokens_unprocessed():
+    lexer = SrcHiliteLexer("py")
+    tokens = list(lexer.get_tokens_unprocessed(CODE))
+    assert "".join(value for _, _, value in tokens) == CODE
+    for offset, _, value in tokens:
+        assert CODE[offset:offset + len(value)] == value
+    assert all(tokentype in PygmentsToken for _, tokentype, _ in tokens)
+
+
+def test_get_tokens():
+    lexer = SrcHiliteLexer("py")
+    obs = [(str(t), v) for t, v in lexer.get_tokens(CODE)]
+    exp = [(str(t), v) for t, v in get_tokens(CODE, "py")]
+    assert obs == exp
+
+
+def test_no_trailing_newline():
+    lexer = SrcHiliteLexer("py", ensurenl=False)
+    tokens = list(lexer.get_tokens_unprocessed("x = 1"))
+    assert "".join(value for _, _, value in tokens) == "x = 1"
+
+
+def test_highlight():
+    assert pygments.highlight(CODE, SrcHiliteLexer("py"), NullFormatter()) == CODE